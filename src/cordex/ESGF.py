@@ -24,9 +24,12 @@ import os
 import copy
 import logging
 import datetime as dt
+import numpy as np
 import pandas as pd
 
 from . import conventions as conv
+from . import DKRZ
+from .catalog import FileCatalog
 
 
 cordex_path_list = ['product','CORDEX_domain','institute_id','driving_model_id', \
@@ -37,11 +40,18 @@ cordex_conv_str  = '{variable}_{CORDEX_domain}_{driving_model_id}_{experiment_id
                    '{startdate}-{enddate}.{suffix}'
 
 
-UNIQUE = ['product', 'CORDEX_domain', 'institute_id', 'driving_model_id', 'experimentd_id',
+UNIQUE = ['product', 'CORDEX_domain', 'institute_id', 'driving_model_id', 'experiment_id',
           'ensemble_member', 'model_id', 'rcm_version_id', 'frequency', 'variable', 'version', 'modeling_realm',
-          'mip_table', 'variable']
+          'mip_table', 'institute', 'model', 'experiment']
 
 date_fmts = {12:'%Y%m%d%H%M', 10:'%Y%m%d%H', 8:'%Y%m%d', 6:'%Y%m', 4:'%Y'}
+date_freqs = {12:'min', 10:'h', 8:'D', 6:'M', 4:'Y'}
+
+# time step between the dates of consecutive files of a frequency
+frequency_steps = {'1hr': pd.Timedelta(hours=1), '3hr': pd.Timedelta(hours=3),
+                   '6hr': pd.Timedelta(hours=6), 'day': pd.Timedelta(days=1),
+                   'mon': pd.DateOffset(months=1), 'sem': pd.DateOffset(months=3),
+                   'yr' : pd.DateOffset(years=1)}
 
 
 
@@ -52,6 +62,112 @@ def format_date(date, freq):
     return date.strftime(date_fmts[freq])
 
 
+def _to_datetime(strings, snap_end=False):
+    """Converts unique date strings grouped by the length of the strings.
+    """
+    lengths = strings.str.len()
+    result  = pd.Series(pd.NaT, index=strings.index, dtype='datetime64[us]')
+    for length, fmt in date_fmts.items():
+        mask = (lengths == length).to_numpy()
+        if not mask.any():
+            continue
+        converted = pd.to_datetime(strings[mask], format=fmt)
+        if snap_end:
+            converted = converted.dt.to_period(date_freqs[length]).dt.end_time
+        result[mask] = converted
+    return result
+
+
+def to_datetime(dates, snap_end=False):
+    """Converts a Series of date strings to datetimes.
+
+    The unique dates are grouped by the length of the date string and
+    each group is converted at once using the corresponding format in
+    ``date_fmts``. Missing dates are converted to ``NaT``.
+
+    Args:
+        dates (Series): Date strings, e.g., ``'19500101'`` or ``'195012'``.
+        snap_end (bool): Snap the dates to the end of the period given
+            by the date string, e.g., ``'195012'`` becomes the last
+            moment of December 1950.
+
+    Returns:
+        Series: dates converted to datetimes.
+
+    """
+    if isinstance(dates.dtype, pd.CategoricalDtype):
+        codes, uniques = dates.cat.codes.to_numpy(), dates.cat.categories
+    else:
+        codes, uniques = pd.factorize(dates)
+    values = _to_datetime(pd.Series(uniques, dtype=object), snap_end).to_numpy()
+    # code -1 of missing dates selects the appended NaT
+    values = np.append(values, np.datetime64('NaT'))
+    return pd.Series(values[codes], index=dates.index, name=dates.name)
+
+
+def _seconds(dates):
+    """Returns datetimes as integer seconds.
+    """
+    return np.asarray(dates, dtype='datetime64[us]').astype('datetime64[s]').astype(np.int64)
+
+
+class TimeIndex(object):
+    """Sorted interval index of the time ranges of files.
+
+    The files are grouped by dataset and sorted by startdate within each
+    dataset. Together with the running maximum of the enddates, each dataset
+    is a sorted run in two global search keys, so that the files overlapping
+    a time range are found by binary searches for all datasets at once.
+
+    Args:
+        start (array): startdates of the files.
+        end (array): enddates of the files.
+        groups (array): integer dataset id of each file.
+
+    """
+
+    def __init__(self, start, end, groups):
+        start = np.asarray(start, dtype='datetime64[us]')
+        end   = np.asarray(end, dtype='datetime64[us]')
+        valid = np.nonzero(~(np.isnat(start) | np.isnat(end)))[0]
+        order = valid[np.lexsort((start[valid], groups[valid]))]
+        self.order  = order
+        self.start  = start[order]
+        self.end    = end[order]
+        self.groups = np.asarray(groups)[order]
+        self.ngroups = int(self.groups.max()) + 1 if len(order) else 0
+        if len(order) == 0:
+            return
+        # running maximum of the enddates within each dataset
+        cummax = pd.Series(_seconds(self.end)).groupby(self.groups).cummax().to_numpy()
+        start_seconds = _seconds(self.start)
+        self.offset = min(start_seconds.min(), cummax.min())
+        self.span   = max(start_seconds.max(), cummax.max()) - self.offset + 1
+        self.start_key = self.groups * self.span + (start_seconds - self.offset)
+        self.end_key   = self.groups * self.span + (cummax - self.offset)
+
+    def overlap(self, start, end):
+        """Returns the sorted positions of files overlapping a time range.
+
+        A file overlaps if it starts before the end and ends after the
+        start of the time range.
+        """
+        if len(self.order) == 0:
+            return np.empty(0, dtype=np.intp)
+        start, end = np.datetime64(start, 'us'), np.datetime64(end, 'us')
+        bases = np.arange(self.ngroups, dtype=np.int64) * self.span
+        t0 = np.clip(_seconds([start])[0] - self.offset, 0, self.span - 1)
+        t1 = np.clip(_seconds([end])[0] - self.offset, 0, self.span - 1)
+        # first file with running max enddate >= start, last file with startdate <= end
+        lower = np.searchsorted(self.end_key, bases + t0, side='left')
+        upper = np.searchsorted(self.start_key, bases + t1, side='right')
+        lengths = np.maximum(upper - lower, 0)
+        total = lengths.sum()
+        candidates = (np.repeat(lower - np.cumsum(lengths) + lengths, lengths) + np.arange(total))
+        # exact check, removes files within the run that end before the start
+        keep = (self.end[candidates] >= start) & (self.start[candidates] <= end)
+        return np.sort(self.order[candidates[keep]])
+
 
 class ESGFFileNameConvention(conv.FileNameConvention):
 
@@ -104,6 +220,26 @@ class CMIP5():
         self.conv_dyn = conv.FileConvention(path_conv, filename_dyn)
         self.conv_fx  = conv.FileConvention(path_conv, filename_fx)
 
+    @property
+    def root(self):
+        return self.conv_dyn.root
+
+    @root.setter
+    def root(self, root):
+        self.conv_dyn.root = root
+
+    @property
+    def path_conv(self):
+        return self.conv_dyn.path_conv
+
+    @property
+    def attr_names(self):
+        """Returns the attribute names of the dynamic and fx conventions.
+        """
+        names = self.conv_dyn.attr_names
+        names += [a for a in self.conv_fx.attr_names if a not in names]
+        return names
+
     def parse(self, file):
         """Parses a file including path and filename and returns attributes.
         """
@@ -114,12 +250,47 @@ class CMIP5():
             attrs = self.conv_dyn.parse(file)
         return attrs
 
-    def pattern(self, **kwargs):
-        if 'variable' in kwargs:
-            if kwargs['variable'] in self.fx_vars:
-                return self.conv_fx.pattern(**kwargs)
-            else:
-                return self.conv_dyn.pattern(**kwargs)
+    def parse_list(self, files):
+        """Parses a list of files in bulk, dispatching between fx and dynamic files.
+
+        Returns:
+            tuple: DataFrame of attributes including the ``path`` column
+            and an array of the rejected files.
+
+        """
+        files = pd.Series(files, dtype=object)
+        path_attrs, _ = self.path_conv.parse_list(conv.dirnames(files))
+        fx = files.index.isin(path_attrs.index[path_attrs['variable'].isin(self.fx_vars)])
+        df_fx, rejected_fx   = self.conv_fx.parse_list(files[fx])
+        df_dyn, rejected_dyn = self.conv_dyn.parse_list(files[~fx])
+        df = pd.concat([df_dyn, df_fx]).sort_index()
+        rejected = files[~files.index.isin(df.index)].to_numpy()
+        return df, rejected
+
+    def explain(self, files):
+        """Explains why files do not conform to the fx or dynamic convention.
+        """
+        files = pd.Series(files, dtype=object)
+        path_attrs, _ = self.path_conv.parse_list(conv.dirnames(files))
+        fx = files.index.isin(path_attrs.index[path_attrs['variable'].isin(self.fx_vars)])
+        return pd.concat([self.conv_dyn.explain(files[~fx]), self.conv_fx.explain(files[fx])],
+                         ignore_index=True)
+
+    def _convention(self, **kwargs):
+        """Returns the fx or dynamic convention depending on the variable.
+
+        Without a variable, the fx convention is returned since its
+        filename pattern also matches dynamic files.
+        """
+        if 'variable' in kwargs and kwargs['variable'] not in self.fx_vars:
+            return self.conv_dyn
+        return self.conv_fx
+
+    def filename(self, **kwargs):
+        return self._convention(**kwargs).filename(**kwargs)
+
+    def pattern(self, root=None, **kwargs):
+        return self._convention(**kwargs).pattern(root=root, **kwargs)
 
 
 
@@ -173,9 +344,8 @@ class ESGFFileSelection(conv.FileSelection):
     def __str__(self):
         text = ''
         text += super().__str__() + '\n'
-        for col in UNIQUE:
-            if col in self.df:
-                text += "{:<30}  :   {}\n".format(col, self.df[col].unique())
+        for col, values in self.unique_values.items():
+            text += "{:<30}  :   {}\n".format(col, values)
         text += "{:<30}  :   {} to {}\n".format('time range', self.timerange[0], self.timerange[1])
         if self.unique:
             text += '\nESGF File Selection is unique.\n'
@@ -185,28 +355,40 @@ class ESGFFileSelection(conv.FileSelection):
 
     def subset(self, **kwargs):
         """Creates a subset by filtering attributes.
+
+        See :meth:`conventions.FileSelection.subset` for the query values.
         """
-        return ESGFFileSelection(super().subset(**kwargs).df)
+        return ESGFFileSelection(self.df.iloc[self.query(**kwargs)], root=self.root, rejected=self.rejected)
 
-    def to_datetime(self):
+    def to_datetime(self, snap_end=False):
         """Converts the date columns to datetime objects.
 
         The date columns (startdate, enddate) are converted to datetime
-        objects depending on the lenght of the date string.
+        objects depending on the lenght of the date string (see
+        :func:`to_datetime`). The selection is sorted by startdate.
+
+        Args:
+            snap_end (bool): Snap the enddate to the end of its period,
+                e.g., ``'195012'`` becomes the last moment of December 1950.
 
         Returns:
              :class:`ESGFFileSelection`: selection converted date columns.
         """
-        df = self.df
-        for index, row in df.iterrows():
-            row['startdate'] = parse_date(row['startdate'])
-            row['enddate']   = parse_date(row['enddate'])
-        df.sort_values(by='startdate', inplace=True)
-        return ESGFFileSelection(df)
+        df = self.df.copy()
+        if not pd.api.types.is_datetime64_any_dtype(df['startdate']):
+            df['startdate'] = to_datetime(df['startdate'])
+        if not pd.api.types.is_datetime64_any_dtype(df['enddate']):
+            df['enddate'] = to_datetime(df['enddate'], snap_end=snap_end)
+        df = df.sort_values(by='startdate', kind='stable')
+        return ESGFFileSelection(df, root=self.root, rejected=self.rejected)
 
     def select_timerange(self, time_range):
         """Returns a selected timerange.
 
+        All files that overlap the time range are selected using the
+        :class:`TimeIndex` of the selection. If the date columns are not
+        converted yet, enddates are snapped to the end of their period.
+
         Args:
             time_range (tuple): Tuple that contains a startdate
                 and enddate in datetime format.
@@ -216,10 +398,82 @@ class ESGFFileSelection(conv.FileSelection):
 
         """
         logging.debug('selecting time range: {} tp {}'.format(time_range[0], time_range[1]))
-        df = self.df[((self.df['startdate'] >= time_range[0]) & (self.df['enddate'] <= time_range[1])) |
-                ((self.df['startdate'] <= time_range[0]) & (self.df['enddate'] >= time_range[0])) |
-                ((self.df['startdate'] <= time_range[1]) & (self.df['enddate'] >= time_range[1]))]
-        return ESGFFileSelection(df)
+        if not pd.api.types.is_datetime64_any_dtype(self.df['startdate']):
+            return self.to_datetime(snap_end=True).select_timerange(time_range)
+        positions = self.time_index.overlap(time_range[0], time_range[1])
+        return ESGFFileSelection(self.df.iloc[positions], root=self.root, rejected=self.rejected)
+
+    def coverage(self):
+        """Detects gaps and overlaps in the time series of all datasets.
+
+        The files of each dataset are sorted by startdate. A file starts
+        a gap if it starts later than one time step of the dataset's
+        frequency (see ``frequency_steps``) after the latest enddate of
+        the preceding files. It overlaps if it starts before that enddate.
+        Files without dates are ignored and gaps are only detected for
+        known frequencies.
+
+        Returns:
+            DataFrame: one row per gap or overlap with the dataset columns,
+            the ``issue`` (``'gap'`` or ``'overlap'``), the ``previous_enddate``,
+            the ``expected`` startdate, the ``startdate`` and the ``path``
+            of the file.
+
+        """
+        if not pd.api.types.is_datetime64_any_dtype(self.df['startdate']):
+            return self.to_datetime().coverage()
+        index = self.time_index
+        groups = pd.Series(index.groups)
+        end = pd.Series(index.end)
+        # latest enddate of all preceding files in the same dataset
+        previous = end.groupby(groups).cummax().groupby(groups).shift(1)
+        expected = pd.Series(pd.NaT, index=previous.index, dtype=previous.dtype)
+        if 'frequency' in self.df:
+            frequency = self.df['frequency'].to_numpy()[index.order]
+            for freq, step in frequency_steps.items():
+                mask = frequency == freq
+                if mask.any():
+                    expected[mask] = previous[mask] + step
+        start = pd.Series(index.start)
+        gap = (start > expected).to_numpy()
+        overlap = (start <= previous).to_numpy()
+        rows = index.order[gap | overlap]
+        issues = self.df.iloc[rows][self.dataset_columns].reset_index(drop=True)
+        issues['issue'] = np.where(overlap[gap | overlap], 'overlap', 'gap')
+        issues['previous_enddate'] = previous[gap | overlap].to_numpy()
+        issues['expected'] = expected[gap | overlap].to_numpy()
+        issues['startdate'] = start[gap | overlap].to_numpy()
+        if 'path' in self.df:
+            issues['path'] = self.df['path'].to_numpy()[rows]
+        return issues
+
+    @property
+    def dataset_columns(self):
+        """Returns the columns that identify a dataset.
+        """
+        return [column for column in UNIQUE if column in self.df]
+
+    @property
+    def dataset_ids(self):
+        """Returns an integer id of the dataset for each file.
+        """
+        if 'dataset_ids' not in self._cache:
+            columns = self.dataset_columns
+            if columns:
+                ids = self.df.groupby(columns, observed=True, sort=False, dropna=False).ngroup()
+                self._cache['dataset_ids'] = ids.to_numpy()
+            else:
+                self._cache['dataset_ids'] = np.zeros(len(self.df), dtype=np.int64)
+        return self._cache['dataset_ids']
+
+    @property
+    def time_index(self):
+        """Returns the cached :class:`TimeIndex` of the selection.
+        """
+        if 'time_index' not in self._cache:
+            self._cache['time_index'] = TimeIndex(self.df['startdate'], self.df['enddate'],
+                                                  self.dataset_ids)
+        return self._cache['time_index']
 
     @property
     def timerange(self):
@@ -243,12 +497,75 @@ class ESGFFileSelection(conv.FileSelection):
             True if selection is unique, false otherwise.
 
         """
-        for column, data in self.df.items():
-            column_in_unique = column in UNIQUE
-            data_unique      = len(data.unique())==1
-            if column_in_unique and not data_unique:
-                return False
-        return True
+        return bool((self.nunique == 1).all())
+
+    def latest(self):
+        """Keeps only the newest version of each dataset.
+
+        The version strings (e.g. ``'v20190925'``) are converted to numbers
+        and the maximum is taken for each dataset regardless of its version.
+        Datasets without a valid version are kept completely.
+
+        Returns:
+             :class:`ESGFFileSelection`: selection of the newest versions.
+        """
+        if 'version' not in self.df:
+            return self
+        columns  = [column for column in self.dataset_columns if column != 'version']
+        versions = conv.version_numbers(self.df['version']).to_numpy()
+        if columns:
+            ids = self.df.groupby(columns, observed=True, sort=False, dropna=False).ngroup().to_numpy()
+        else:
+            ids = np.zeros(len(self.df), dtype=np.int64)
+        newest = pd.Series(versions).groupby(ids).transform('max').to_numpy()
+        keep = (versions == newest) | np.isnan(newest)
+        return ESGFFileSelection(self.df[keep], root=self.root, rejected=self.rejected)
+
+    @property
+    def unique_values(self):
+        """Returns the unique values of the dataset columns.
+
+        The values are computed once per selection.
+
+        Returns:
+            dict: unique values of each dataset column.
+
+        """
+        if 'unique_values' not in self._cache:
+            self._cache['unique_values'] = {column: conv.unique_values(self.df[column])
+                                            for column in self.dataset_columns}
+        return self._cache['unique_values']
+
+    @property
+    def nunique(self):
+        """Returns the number of unique values of the dataset columns.
+
+        Returns:
+            Series: number of unique values indexed by column.
+
+        """
+        return pd.Series({column: len(values) for column, values in self.unique_values.items()},
+                         dtype=int)
+
+    def datasets(self):
+        """Splits the selection into atomic datasets.
+
+        A dataset is the time series of files that share the same values in
+        all dataset columns (see :attr:`dataset_columns`). The row positions
+        of the datasets are computed once from the :attr:`dataset_ids`.
+
+        Returns:
+            dict: :class:`ESGFFileSelection` of each dataset, keyed by the tuple
+            of the dataset column values.
+
+        """
+        ids   = self.dataset_ids
+        order = np.argsort(ids, kind='stable')
+        bounds = np.searchsorted(ids[order], np.arange(ids.max() + 2 if len(ids) else 1))
+        keys = self.df[self.dataset_columns].iloc[order[bounds[:-1]]].itertuples(index=False, name=None)
+        return {key: ESGFFileSelection(self.df.iloc[order[start:stop]], root=self.root,
+                                       rejected=self.rejected)
+                for key, start, stop in zip(keys, bounds[:-1], bounds[1:])}
 
 
 def select_files(project_id, filter={}, root=None, **kwargs):
@@ -261,10 +578,36 @@ def select_files(project_id, filter={}, root=None, **kwargs):
 def file_selection_from_scratch():
     pass
 
-def file_selection_from_csv(filename):
-    return ESGFFileSelection(pd.from_csv(filename))
+def file_selection_from_csv(filename, root=None):
+    """Reads a selection written by :meth:`conventions.FileSelection.to_csv`.
+    """
+    df = pd.read_csv(filename, index_col=0, dtype=str)
+    for column in ('size', 'mtime'):
+        if column in df:
+            df[column] = pd.to_numeric(df[column])
+    attrs = [c for c in df if c not in ('path', 'size', 'mtime')]
+    return ESGFFileSelection(conv.categorize(df, attrs), root=root)
+
+
+def file_selection_from_parquet(filename, columns=None, filter={}):
+    """Reads a selection from a Parquet file.
+
+    See :func:`conventions.read_selection` for the arguments.
+    """
+    return conv.read_selection(filename, columns=columns, filter=filter, format='parquet',
+                               cls=ESGFFileSelection)
+
+
+def file_selection_from_feather(filename, columns=None, filter={}):
+    """Reads a selection from a Feather file.
 
-def get_selection(convention_id, filter={}, root=None, **kwargs):
+    See :func:`conventions.read_selection` for the arguments.
+    """
+    return conv.read_selection(filename, columns=columns, filter=filter, format='feather',
+                               cls=ESGFFileSelection)
+
+def get_selection(convention_id, filter={}, root=None, catalog=None, workers=None, stat=False,
+                  instrument=None, errors='collect', **kwargs):
     """Top level function to create a :class:`ESGFFileSelection` instance.
 
     This function creates a :class:`FileSelection` instance
@@ -274,15 +617,35 @@ def get_selection(convention_id, filter={}, root=None, **kwargs):
         convention_id (str): The name of the convention.
         filter (dict): Defines attributes to filer the search.
         root (str): The root directory where the convention holds.
+        catalog (:class:`cordex.catalog.FileCatalog`): If given, the
+            selection is queried from the catalog instead of the filesystem.
+        workers (int): Number of processes used for parsing the files.
+        stat (bool): Add the ``size`` and ``mtime`` of each file.
+        instrument (:class:`cordex.metrics.Instrument`): Receives crawl
+            and parse metrics, see :mod:`cordex.metrics`.
+        errors (str): Policy for files that do not conform to the convention,
+            ``'skip'``, ``'collect'`` or ``'raise'``. Collected files are
+            available as ``rejected`` table of the selection.
+        **kwargs: Passed to :func:`conventions.select_files`, e.g.,
+            ``latest=True`` to only keep the newest version of each dataset.
+            If ``version`` is the last path level, older version directories
+            are not searched at all, otherwise :meth:`ESGFFileSelection.latest`
+            is applied to the parsed files.
 
     Returns:
         :class:`ESGFFileSelection` object.
 
     """
+    if catalog is not None:
+        return ESGFFileSelection(catalog.query(**filter), root=catalog.root)
     convention = get_convention(convention_id, root=root)
-    files      = conv.select_files(convention, filter, root, **kwargs)
-    df         = conv.make_df(convention, files)
-    return ESGFFileSelection(df)
+    files      = conv.select_files(convention, filter, root, stat=stat, instrument=instrument, **kwargs)
+    df, rejected = conv.make_table(convention, files, workers=workers, instrument=instrument,
+                                   errors=errors)
+    selection = ESGFFileSelection(df, root=convention.root or None, rejected=rejected)
+    if kwargs.get('latest') and convention.path_conv.conv_list[-1] != 'version':
+        selection = selection.latest()
+    return selection
 
 
 def conventions():
@@ -294,6 +657,38 @@ def conventions():
     return _ConventionFactory.names()
 
 
+def detect_convention(root, **kwargs):
+    """Detects the convention of an archive from a sample of its files.
+
+    The ESGF conventions and the DKRZ conventions for reanalysis data are
+    tested, see :func:`conventions.detect`.
+
+    Args:
+        root (str): The root directory of the archive.
+        **kwargs: Passed to :func:`conventions.sample_files`, e.g.,
+            ``walks`` or ``timeout``.
+
+    Returns:
+        :class:`conventions.Detection` with the best convention and its confidence.
+
+    """
+    return conv.detect(root, _ConventionFactory.conventions() + [DKRZ.ERA5, DKRZ.ECMWF], **kwargs)
+
+
+def get_catalog(convention_id, filename, root=None):
+    """Opens a persistent file catalog for an ESGF convention.
+
+    Args:
+        convention_id (str): The name of the convention.
+        filename (str): The SQLite file holding the catalog.
+        root (str): The root directory where the convention holds.
+
+    Returns:
+        :class:`cordex.catalog.FileCatalog` object.
+    """
+    return FileCatalog(filename, get_convention(convention_id, root=root))
+
+
 def get_convention(name, root=None):
     """Returns a ESGS convention instance.
 
@@ -0,0 +1,531 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+"""catalog module
+
+This module defines a persistent file catalog in the :class:`FileCatalog`.
+
+The catalog stores the attributes of all files found under the root of a
+:class:`conventions.FileConvention` in an SQLite index on disk. Together
+with the files, the modification times of all directories are recorded,
+so that a :meth:`FileCatalog.refresh` only has to list directories that
+have changed since the last crawl.
+
+Changes between two crawls can be found with :func:`diff`.
+For processing with many worker processes, a selection can be shared
+in a :class:`SharedCatalog` backed by a memory mapped Arrow IPC file.
+
+Example:
+
+    To crawl an archive once and query it later, you can use, e.g.,::
+
+        from cordex import ESGF
+
+        catalog = ESGF.get_catalog('CORDEX', 'cordex.db', root='/pool/data/cordex')
+        catalog.refresh()
+        selection = ESGF.get_selection('CORDEX', filter={'variable': 'tas'},
+                                       catalog=catalog)
+
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import tempfile
+import numpy as np
+import logging
+import pandas as pd
+from collections import namedtuple
+
+from . import conventions as conv
+from . import metrics
+
+
+__author__ = "Lars Buntemeyer"
+__copyright__ = "Lars Buntemeyer"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def _quote(name):
+    """Quotes an SQL identifier.
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class FileCatalog(object):
+    """Persistent catalog of files according to a convention.
+
+    The catalog holds one row per file with the attributes parsed from
+    path and filename. Paths are stored relative to the root of the
+    convention.
+
+    Args:
+        filename (str): The SQLite file holding the catalog.
+        convention (:class:`conventions.FileConvention`): The convention
+            of the archive. The convention must have a root.
+
+    """
+
+    def __init__(self, filename, convention):
+        if not convention.root:
+            raise Exception('catalog requires a convention with a root directory.')
+        self.filename   = filename
+        self.convention = convention
+        self.attr_names = convention.attr_names
+        self.nlevels    = len(convention.path_conv.conv_list)
+        self.con        = sqlite3.connect(filename)
+        self.rejected   = pd.DataFrame(columns=conv.rejected_columns)
+        self._create_tables()
+
+    @property
+    def root(self):
+        return self.convention.root
+
+    def _create_tables(self):
+        columns = ', '.join('{} TEXT'.format(_quote(a)) for a in self.attr_names
+                            if a not in ('path', 'dir'))
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS dirs '
+                             '(dir TEXT PRIMARY KEY, parent TEXT, mtime REAL)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS files '
+                             '(path TEXT PRIMARY KEY, dir TEXT, {})'.format(columns))
+            self.con.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+
+    def close(self):
+        self.con.close()
+
+    def __len__(self):
+        return self.con.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def _parse_files(self, rel_dir, names, instrument=metrics.NULL, errors='collect'):
+        """Parses files in a leaf directory and returns rows for the files table.
+        """
+        files = [os.path.join(self.root, rel_dir, name) for name in names]
+        start = time.perf_counter()
+        df, rejected = self.convention.parse_list(files)
+        instrument.parsed(len(files), time.perf_counter() - start)
+        instrument.rejected(len(rejected))
+        if len(rejected):
+            self._rejected.append(conv.handle_rejected(self.convention, rejected, errors))
+        df = df.reindex(columns=self.attr_names)
+        df.insert(0, 'dir', rel_dir)
+        df.insert(0, 'path', [os.path.join(rel_dir, names[i]) for i in df.index])
+        return df.astype(object).where(df.notna(), None).values.tolist()
+
+    def _update_dir(self, rel_dir, names, instrument=metrics.NULL, errors='collect'):
+        """Applies inserts and deletes for the files of a leaf directory.
+        """
+        stored = set(r[0] for r in self.con.execute(
+                     'SELECT path FROM files WHERE dir = ?', (rel_dir,)))
+        current = set(os.path.join(rel_dir, name) for name in names)
+        removed = stored - current
+        added   = [os.path.basename(p) for p in sorted(current - stored)]
+        self.con.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in removed])
+        rows = self._parse_files(rel_dir, added, instrument, errors)
+        if rows:
+            columns = ', '.join(_quote(c) for c in ['path', 'dir'] + self.attr_names)
+            values  = ', '.join('?' * (len(self.attr_names) + 2))
+            self.con.executemany('INSERT INTO files ({}) VALUES ({})'.format(columns, values), rows)
+        return len(rows), len(removed)
+
+    def refresh(self, instrument=None, errors='collect'):
+        """Synchronizes the catalog with the filesystem.
+
+        Directories are only listed if their modification time has changed
+        since the last refresh. Files in changed leaf directories are inserted
+        or deleted incrementally, directories that have disappeared are removed
+        from the catalog together with their files. Hidden and non-matching
+        entries are skipped like by :func:`conventions.crawl`, directories
+        that can not be read keep their files and are listed again on the
+        next refresh.
+
+        Args:
+            instrument (:class:`cordex.metrics.Instrument`): Receives the
+                directory listings and parsed files, see :mod:`cordex.metrics`.
+            errors (str): Policy for files that do not conform to the
+                convention, see :func:`conventions.handle_rejected`. Collected
+                files of the refresh are available as ``rejected`` table.
+
+        Returns:
+            tuple: number of inserted and deleted files.
+
+        """
+        instrument = metrics.get_instrument(instrument)
+        self._rejected = []
+        walker = conv._Walker(self.convention)
+        mtimes = dict(self.con.execute('SELECT dir, mtime FROM dirs'))
+        visited = set()
+        inserted, deleted = 0, 0
+        stack = [('', None)]
+        with self.con:
+            while stack:
+                rel_dir, parent = stack.pop()
+                full_dir = os.path.join(self.root, rel_dir)
+                try:
+                    mtime = os.stat(full_dir).st_mtime
+                except FileNotFoundError:
+                    continue
+                visited.add(rel_dir)
+                depth = len(rel_dir.split(os.sep)) if rel_dir else 0
+                if mtimes.get(rel_dir) == mtime:
+                    if depth < self.nlevels:
+                        children = self.con.execute('SELECT dir FROM dirs WHERE parent = ?', (rel_dir,))
+                        stack.extend((child, rel_dir) for (child,) in children)
+                    continue
+                _logger.debug('scanning changed directory: {}'.format(full_dir))
+                entries, seconds = conv._listdir(os.scandir, full_dir, instrument)
+                if entries is None:
+                    # keep the catalog of unreadable directories and retry on the next refresh
+                    visited.update(d for d in mtimes if d.startswith(os.path.join(rel_dir, '')))
+                    continue
+                instrument.listed(full_dir, depth, len(entries), seconds)
+                dirs, files = walker.expand(full_dir, depth, entries)
+                if depth < self.nlevels:
+                    stack.extend((os.path.relpath(path, self.root), rel_dir) for path, level in dirs)
+                else:
+                    names = [entry.name for path, entry in files]
+                    instrument.matched(len(names))
+                    i, d = self._update_dir(rel_dir, names, instrument, errors)
+                    inserted += i
+                    deleted  += d
+                self.con.execute('INSERT OR REPLACE INTO dirs (dir, parent, mtime) VALUES (?, ?, ?)',
+                                 (rel_dir, parent, mtime))
+            for rel_dir in set(mtimes) - visited:
+                deleted += self.con.execute('DELETE FROM files WHERE dir = ?', (rel_dir,)).rowcount
+                self.con.execute('DELETE FROM dirs WHERE dir = ?', (rel_dir,))
+        self.rejected = pd.concat([pd.DataFrame(columns=conv.rejected_columns)] + self._rejected,
+                                  ignore_index=True)
+        _logger.info('catalog refreshed: {} files inserted, {} deleted'.format(inserted, deleted))
+        return inserted, deleted
+
+    def query(self, **kwargs):
+        """Queries the catalog by filtering attributes.
+
+        Attributes may have a single value or a list of values.
+
+        Returns:
+            DataFrame: file attributes as categoricals and paths
+            relative to the root.
+
+        """
+        sql = 'SELECT * FROM files'
+        conditions, params = [], []
+        for key, value in kwargs.items():
+            value = conv.values(value)
+            conditions.append('{} IN ({})'.format(_quote(key), ', '.join('?' * len(value))))
+            params.extend(value)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        df = pd.read_sql_query(sql, self.con, params=params)
+        df = df.drop(columns='dir')[self.attr_names + ['path']]
+        return conv.categorize(df, self.attr_names)
+
+
+def _shared_directory():
+    """Returns the directory for shared catalogs, preferably in memory.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class SharedCatalog(object):
+    """Selection shared between processes in a memory mapped Arrow IPC file.
+
+    The table is written once by :meth:`create` and attached by name in
+    other processes. Attaching maps the file into memory, so that the
+    columns are shared by all processes through the page cache instead of
+    being copied into each of them. Only the name and location are pickled,
+    so that passing a shared catalog to a worker takes constant time
+    regardless of its size.
+
+    Example:
+
+        To fan out over the files of a selection, you can use, e.g.,::
+
+            def process(shared, offset, length):
+                for filename in shared.selection(offset, length).file_list:
+                    ...
+
+            with SharedCatalog.create(selection) as shared:
+                with ProcessPoolExecutor(max_workers=8) as executor:
+                    for offset, length in shared.chunks(8):
+                        executor.submit(process, shared, offset, length)
+
+    Args:
+        name (str): The name of the shared catalog.
+        directory (str): The directory holding the file, defaults to
+            ``/dev/shm`` if available or the temporary directory.
+
+    """
+
+    def __init__(self, name, directory=None):
+        self.name      = name
+        self.directory = directory or _shared_directory()
+        self._table    = None
+        self._source   = None
+        self._owner    = False
+
+    @classmethod
+    def create(cls, selection, name=None, directory=None):
+        """Writes a selection into a new shared catalog.
+
+        Args:
+            selection (:class:`conventions.FileSelection`): The selection
+                to share.
+            name (str): The name of the shared catalog, a unique name
+                is created if ``None``.
+            directory (str): The directory holding the file.
+
+        Returns:
+            :class:`SharedCatalog` that owns the file.
+
+        """
+        conv._import_pyarrow()
+        import pyarrow as pa
+        shared = cls(name or 'cordex-{}'.format(uuid.uuid4().hex), directory)
+        table = selection.to_arrow()
+        with pa.OSFile(shared.filename, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        shared._owner = True
+        return shared
+
+    @classmethod
+    def attach(cls, name, directory=None):
+        """Attaches to an existing shared catalog by name.
+        """
+        shared = cls(name, directory)
+        if not os.path.isfile(shared.filename):
+            raise Exception('shared catalog not found: {}'.format(shared.filename))
+        return shared
+
+    @property
+    def filename(self):
+        return os.path.join(self.directory, self.name + '.arrow')
+
+    @property
+    def table(self):
+        """The memory mapped :class:`pyarrow.Table`, read without copying.
+        """
+        if self._table is None:
+            import pyarrow as pa
+            self._source = pa.memory_map(self.filename, 'r')
+            self._table = pa.ipc.open_file(self._source).read_all()
+        return self._table
+
+    @property
+    def root(self):
+        metadata = (self.table.schema.metadata or {}).get(conv._arrow_metadata_key)
+        return json.loads(metadata).get('root') if metadata else None
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def chunks(self, n):
+        """Splits the rows into ``n`` contiguous chunks.
+
+        Returns:
+            list: tuples of offset and length of each chunk.
+        """
+        bounds = [len(self) * i // n for i in range(n + 1)]
+        return [(start, stop - start) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def slice(self, offset=0, length=None, columns=None):
+        """Returns a slice of the catalog as a DataFrame.
+
+        Only the rows and columns of the slice are converted.
+        """
+        table = self.table.slice(offset, length)
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas()
+
+    def selection(self, offset=0, length=None, columns=None, cls=None):
+        """Returns a slice of the catalog as a selection.
+
+        Args:
+            cls (type): The selection class, defaults to
+                :class:`conventions.FileSelection`.
+
+        """
+        cls = cls or conv.FileSelection
+        return cls(self.slice(offset, length, columns), root=self.root)
+
+    def close(self):
+        """Releases the mapping and removes the file if this catalog created it.
+        """
+        self._table = None
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._owner and os.path.exists(self.filename):
+            os.remove(self.filename)
+        self._owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        return {'name': self.name, 'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['directory'])
+
+
+CatalogDiff = namedtuple('CatalogDiff', ['added', 'removed', 'modified'])
+CatalogDiff.__doc__ = """Result of :func:`diff`.
+
+The ``added`` and ``removed`` files are DataFrames with the ``path`` and
+the compared columns of the new and old catalog, other catalog columns are
+not carried through. The ``modified`` files have the compared columns of
+both catalogs with the suffixes ``_old`` and ``_new``.
+"""
+
+_diff_types = {'size': 'int64', 'mtime': 'float64'}
+
+
+def _frame(source):
+    """Returns the DataFrame of a selection, the filename of a file.
+    """
+    if isinstance(source, FileCatalog):
+        raise Exception('a FileCatalog stores no size and mtime of files and can not be '
+                        'compared, use a selection with stat=True or a Parquet/Feather file')
+    if isinstance(source, conv.FileSelection):
+        return source.df
+    return source
+
+
+def _diff_columns(source):
+    """Returns the column names of a DataFrame or file.
+    """
+    if isinstance(source, pd.DataFrame):
+        return list(source.columns)
+    import pyarrow.dataset as ds
+    return ds.dataset(source, format=conv.arrow_format(source)).schema.names
+
+
+def _batches(source, columns, batch_size):
+    """Yields chunks of a DataFrame or Parquet/Feather file.
+    """
+    if not isinstance(source, pd.DataFrame):
+        import pyarrow.dataset as ds
+        for batch in ds.dataset(source, format=conv.arrow_format(source)).to_batches(columns=columns,
+                                                                                      batch_size=batch_size):
+            yield batch.to_pandas()
+        return
+    source = source[columns]
+    for start in range(0, len(source), batch_size):
+        yield source.iloc[start:start + batch_size]
+
+
+def _normalize(df, columns):
+    """Converts the compared columns to plain types.
+    """
+    return pd.DataFrame({c: df[c].astype(_diff_types[c]).to_numpy() if c in _diff_types
+                         else df[c].astype(str).to_numpy() for c in columns})
+
+
+def _partition_ids(paths, partitions):
+    return pd.util.hash_array(paths.to_numpy(dtype=object), categorize=False) % np.uint64(partitions)
+
+
+def _spill(source, columns, partitions, batch_size, directory, tag):
+    """Hash partitions a source on the path into Arrow IPC files.
+
+    Returns:
+        list: the filename of each partition.
+    """
+    import pyarrow as pa
+    schema = pa.schema([(c, pa.from_numpy_dtype(np.dtype(_diff_types[c])) if c in _diff_types
+                         else pa.string()) for c in columns])
+    filenames = [os.path.join(directory, '{}-{}.arrow'.format(tag, i)) for i in range(partitions)]
+    writers = [pa.ipc.new_file(f, schema) for f in filenames]
+    try:
+        for batch in _batches(source, columns, batch_size):
+            batch = _normalize(batch, columns)
+            ids = _partition_ids(batch['path'], partitions)
+            for i, group in batch.groupby(ids, sort=False):
+                writers[int(i)].write_table(pa.Table.from_pandas(group, schema=schema, preserve_index=False))
+    finally:
+        for writer in writers:
+            writer.close()
+    return filenames
+
+
+def _diff_frames(old, new, compare):
+    """Compares two frames with a hash join on the path.
+
+    See :func:`conventions.join_columns`.
+    """
+    positions, matched = conv.join_columns(old['path'], new['path'])
+    found = positions >= 0
+    before = old.iloc[positions[found]].reset_index(drop=True)
+    after  = new[found].reset_index(drop=True)
+    changed = np.zeros(len(after), dtype=bool)
+    for c in compare:
+        a, b = before[c], after[c]
+        changed |= (~((a == b) | (a.isna() & b.isna()))).to_numpy()
+    modified = pd.DataFrame({'path': after['path']})
+    for c in compare:
+        modified[c + '_old'] = before[c]
+        modified[c + '_new'] = after[c]
+    return (new[~found].reset_index(drop=True), old[~matched].reset_index(drop=True),
+            modified[changed].reset_index(drop=True))
+
+
+def diff(old, new, compare=('size', 'mtime'), partitions=1, batch_size=1000000):
+    """Compares two catalogs and returns the changed files.
+
+    Files are identified by their ``path`` relative to the root, so both
+    catalogs should have the same root. The catalogs are joined by hashing
+    the pathes. For large catalogs, both are split into ``partitions`` by a
+    hash of the path and spilled to temporary files chunk by chunk, so that
+    only one partition of each catalog is held in memory for the join.
+
+    Example:
+
+        To compare a persisted selection with a fresh crawl, you can use, e.g.,::
+
+            new = ESGF.get_selection('CORDEX', root=root, stat=True)
+            changes = catalog.diff('selection.parquet', new, partitions=16)
+            changes.modified
+
+    Args:
+        old: The old catalog, a :class:`conventions.FileSelection`,
+            DataFrame or Parquet/Feather filename. A :class:`FileCatalog`
+            can not be compared since it stores no size and mtime.
+        new: The new catalog, of the same types as ``old``.
+        compare (tuple): Columns that mark a file as modified, e.g.,
+            ``size`` and ``mtime`` from a crawl with ``stat=True``. Columns
+            missing in one of the catalogs are ignored.
+        partitions (int): Number of hash partitions.
+        batch_size (int): Number of rows read at once while partitioning.
+
+    Returns:
+        :class:`CatalogDiff` of the added, removed and modified files.
+
+    """
+    old, new = _frame(old), _frame(new)
+    old_columns, new_columns = _diff_columns(old), _diff_columns(new)
+    compare = [c for c in compare if c in old_columns and c in new_columns]
+    columns = ['path'] + compare
+    if partitions <= 1 and isinstance(old, pd.DataFrame) and isinstance(new, pd.DataFrame):
+        return CatalogDiff(*_diff_frames(_normalize(old, columns), _normalize(new, columns), compare))
+    conv._import_pyarrow()
+    import pyarrow as pa
+    results = []
+    with tempfile.TemporaryDirectory(prefix='cordex-diff-') as directory:
+        old_parts = _spill(old, columns, partitions, batch_size, directory, 'old')
+        new_parts = _spill(new, columns, partitions, batch_size, directory, 'new')
+        for old_part, new_part in zip(old_parts, new_parts):
+            frames = [pa.ipc.open_file(pa.memory_map(f)).read_all().to_pandas() for f in (old_part, new_part)]
+            results.append(_diff_frames(frames[0], frames[1], compare))
+    return CatalogDiff(*[pd.concat([r[i] for r in results], ignore_index=True) for i in range(3)])
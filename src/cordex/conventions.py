@@ -8,14 +8,24 @@ This module defines file naming conventions in the :class:`FileConvention`.
 
 import os
 import glob
+import asyncio
+import itertools
+import json
+import time
+import random
+import hashlib
+import fnmatch
 import pandas as pd
 import numpy as np
 import logging
-from parse import parse
+import re
 import string
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path, PurePath
 from cordex import __version__
 from .utils import printProgressBar
+from . import metrics
 
 
 __author__ = "Lars Buntemeyer"
@@ -59,6 +69,175 @@ class PartialFormatter(string.Formatter):
             else: raise
 
 
+def values(value):
+    """Returns the values of a filter attribute as a list.
+    """
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+def expand_filter(filter):
+    """Expands a filter with lists of values into single valued filters.
+
+    Example:
+
+        ``{'variable': ['tas', 'pr'], 'frequency': 'day'}`` is expanded to
+        ``[{'variable': 'tas', 'frequency': 'day'}, {'variable': 'pr', 'frequency': 'day'}]``.
+
+    Returns:
+        list: filters of the cartesian product of all values.
+
+    """
+    keys = list(filter)
+    return [dict(zip(keys, combination)) for combination in
+            itertools.product(*[values(filter[key]) for key in keys])]
+
+
+def _fixed_prefixes(paths, level, levels):
+    """Appends levels with fixed values to pathes.
+
+    Levels are appended as long as none of their patterns contains
+    wildcards. A level with several values multiplies the pathes.
+
+    Returns:
+        tuple: list of pathes and the first level that is not fixed.
+    """
+    while level < len(levels) and not any(glob.has_magic(p) for p in levels[level]):
+        paths = [os.path.join(path, value) for path in paths for value in levels[level]]
+        level += 1
+    return paths, level
+
+
+class ParseError(Exception):
+    """Raised if a file does not conform to a convention.
+
+    Args:
+        path (str): The file or directory that could not be parsed.
+        level (str): The level of the convention that failed, i.e.,
+            ``'root'``, ``'path'`` or ``'filename'``.
+        reason (str): Describes why parsing failed.
+
+    """
+
+    def __init__(self, path, level, reason):
+        Exception.__init__(self, '{} ({} level): {}'.format(path, level, reason))
+        self.path   = path
+        self.level  = level
+        self.reason = reason
+
+
+# policies for files that do not conform to a convention
+error_policies = ('skip', 'collect', 'raise')
+
+rejected_columns = ['path', 'level', 'reason']
+
+
+def handle_rejected(convention, rejected, errors='collect'):
+    """Applies the error policy to files that could not be parsed.
+
+    Args:
+        convention: The convention used for parsing, it has to implement
+            ``explain``.
+        rejected (list): The rejected files.
+        errors (str): ``'skip'`` ignores rejected files, ``'collect'``
+            returns a table of rejected files with the reason and the level
+            of the convention that failed, ``'raise'`` raises a
+            :class:`ParseError` for the first rejected file.
+
+    Returns:
+        DataFrame: the rejected files with the columns ``path``, ``level``
+        and ``reason`` (empty, if ``errors`` is ``'skip'``).
+
+    """
+    if errors not in error_policies:
+        raise Exception('unknown error policy: {}, use one of {}'.format(errors, error_policies))
+    if errors == 'skip' or len(rejected) == 0:
+        return pd.DataFrame(columns=rejected_columns)
+    if errors == 'raise':
+        table = convention.explain(list(rejected[:1]))
+        raise ParseError(*table.iloc[0])
+    table = convention.explain(list(rejected))
+    _logger.warning('{} files do not conform to the convention'.format(len(table)))
+    return table
+
+
+def format_frame(conv_str, df):
+    """Formats a convention string for all rows of a DataFrame.
+
+    The strings are built column by column from the tokens of the
+    convention string instead of formatting each row separately.
+
+    Returns:
+        Series: the formatted strings.
+
+    """
+    result = pd.Series('', index=df.index, dtype=str)
+    for literal, field, spec, conversion in string.Formatter().parse(conv_str):
+        if literal:
+            result = result + literal
+        if field is not None:
+            if spec:
+                values = df[field].map(('{:' + spec + '}').format)
+            else:
+                values = df[field]
+            result = result + values.astype(str)
+    return result
+
+
+def file_checksum(filename, algorithm='sha256', buffer_size=8 * 1024 * 1024):
+    """Computes the checksum of a file.
+
+    The file is read sequentially in large blocks into a reused buffer.
+    The hash functions of :mod:`hashlib` release the GIL, so that files
+    can be hashed in parallel by threads.
+    """
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def dirnames(files):
+    """Returns the directory names of a Series of files.
+    """
+    return pd.Series([f.rpartition(os.sep)[0] for f in files], index=files.index, dtype=object)
+
+
+def match_list(expressions, strings):
+    """Matches a list of strings against compiled expressions.
+
+    Each string is matched against the expressions in order
+    until one of them matches completely.
+
+    Args:
+        expressions (list): Compiled regular expressions with the same groups.
+        strings (Series): The strings to match.
+
+    Returns:
+        tuple: DataFrame of the matched groups (columns numbered by group,
+        indexed like the matched strings) and a boolean mask of matches.
+
+    """
+    def match(s):
+        for expression in expressions:
+            m = expression.fullmatch(s)
+            if m:
+                return m.groups()
+        return None
+    groups = [match(s) for s in strings]
+    valid  = np.fromiter((g is not None for g in groups), dtype=bool, count=len(groups))
+    df = pd.DataFrame([g for g in groups if g is not None], index=strings.index[valid],
+                      columns=range(expressions[0].groups))
+    return df, valid
+
+
 class NamingConvention():
 
     def __init__(self, formatter=None, missing='*'):
@@ -84,6 +263,73 @@ class NamingConvention():
 ##        return ('{:'+self.fmt+'}').format(fill)
 
 
+_format_spec = re.compile(r'^(?:.?[<>=^])?(?P<zero>0)?(?P<width>\d+)?'
+                          r'(?:\.(?P<precision>\d+))?(?P<type>[a-zA-Z%]?)$')
+
+
+def _field_regex(spec):
+    """Returns a regular expression and a converter for a format spec.
+    """
+    match = _format_spec.match(spec or '')
+    if match is None:
+        return '.+?', None
+    width, precision, type = match.group('width'), match.group('precision'), match.group('type')
+    if type == 'd':
+        if width:
+            return r'[-+]?\d{{1,{}}}'.format(width), int
+        return r'[-+]?\d+', int
+    if type in ('', 's'):
+        if precision:
+            return '.{{1,{}}}?'.format(precision), None
+        if width:
+            return '.{{{},}}?'.format(width), None
+    return '.+?', None
+
+
+def compile_convention(conv_str, greedy=False):
+    """Compiles a convention string into a regular expression.
+
+    Each field of the convention string becomes a named group, repeated
+    fields have to match the same value. By default, fields match lazily
+    like in the :mod:`parse` module. With ``greedy=True``, a field that is
+    followed by a separator can not contain that separator. Such an expression
+    matches without backtracking and, if it matches, yields the same result
+    as the lazy expression.
+
+    Args:
+        conv_str (str): The convention string, e.g., ``'{model}_{domain}.{suffix}'``.
+        greedy (bool): Create the faster expression without backtracking.
+
+    Returns:
+        tuple: The compiled expression and a dictionary of converters
+        for fields that are not strings.
+
+    """
+    tokens = list(string.Formatter().parse(conv_str))
+    regex = ''
+    fields = set()
+    converters = {}
+    for i, (literal, field, spec, conversion) in enumerate(tokens):
+        regex += re.escape(literal)
+        if field is None:
+            continue
+        if field in fields:
+            regex += '(?P={})'.format(field)
+            continue
+        expression, converter = _field_regex(spec)
+        if greedy and expression == '.+?':
+            following = tokens[i + 1][0] if i + 1 < len(tokens) else None
+            if following is None:
+                expression = '.+'
+            elif following:
+                expression = '[^{}]+'.format(re.escape(following[0]))
+        regex += '(?P<{}>{})'.format(field, expression)
+        fields.add(field)
+        if converter is not None:
+            converters[field] = converter
+    return re.compile(regex), converters
+
+
 class FileNameConvention(NamingConvention):
     """creates and parse filenames according to a convention.
     """
@@ -93,9 +339,10 @@ class FileNameConvention(NamingConvention):
         self.conv_str    = conv_str
         self.any_str     = missing
         # save the attribtes from the convention str
-        #self.attr_names  = parse(self.conv_str, self.conv_str, self.parse_dict).named.keys()
         self.attr_names = [t[1] for t in string.Formatter().parse(conv_str) if t[1] is not None]
         self.defaults    = {attr:self.any_str for attr in self.attr_names}
+        self.regex, self.converters = compile_convention(conv_str)
+        self._greedy_regex, _ = compile_convention(conv_str, greedy=True)
 
     def parse_attrs(self, attrs):
         return attrs
@@ -103,16 +350,52 @@ class FileNameConvention(NamingConvention):
     def format_attrs(self, attrs, any_str):
         return attrs
 
+    def _match(self, filename):
+        return self._greedy_regex.fullmatch(filename) or self.regex.fullmatch(filename)
+
+    def format_frame(self, df):
+        """Creates a filename for each row of a DataFrame of attributes.
+        """
+        return format_frame(self.conv_str, df)
+
     def parse(self, filename):
         """Parses a filename and returns attributes.
         """
-        parsed = parse(self.conv_str, os.path.basename(filename))
-        if parsed:
-            return self.parse_attrs(parsed.named)
+        match = self._match(os.path.basename(filename))
+        if match:
+            attrs = match.groupdict()
+            for key, converter in self.converters.items():
+                attrs[key] = converter(attrs[key])
+            return self.parse_attrs(attrs)
         else:
-            print('parsing not successful for {}'.format(filename))
+            _logger.debug('parsing not successful for {}'.format(filename))
             return None
 
+    def parse_list(self, filenames):
+        """Parses a list of filenames in bulk.
+
+        Args:
+            filenames (list): Filenames, optionally including pathes.
+
+        Returns:
+            tuple: DataFrame of attributes for the filenames that match
+            the convention (indexed by position in the input list) and
+            an array of the rejected filenames.
+
+        """
+        filenames = pd.Series(filenames, dtype=object)
+        basenames = pd.Series([f.rpartition(os.sep)[2] for f in filenames], index=filenames.index)
+        attrs, valid = match_list([self._greedy_regex, self.regex], basenames)
+        attrs.columns = list(self.regex.groupindex)
+        return self.convert(attrs), filenames[~valid].to_numpy()
+
+    def convert(self, attrs):
+        """Applies the converters of non-string fields to parsed attributes.
+        """
+        for key, converter in self.converters.items():
+            attrs[key] = attrs[key].map(converter)
+        return attrs
+
     def pattern(self, **kwargs):
         """Creates a filename pattern from attributes.
         """
@@ -153,6 +436,11 @@ class FilePathConvention(NamingConvention):
         """
         return os.path.join(*self.conv_list)
 
+    def format_frame(self, df):
+        """Creates a path relative to the root for each row of a DataFrame of attributes.
+        """
+        return format_frame(os.path.join(*['{' + key + '}' for key in self.conv_list]), df)
+
     def parse(self, path):
         """Parses a path and returns attributes.
         """
@@ -160,11 +448,47 @@ class FilePathConvention(NamingConvention):
             path = str(PurePath(path).relative_to(self.root))
         values = path.split(os.sep)
         if len(values) != len(self.conv_list):
-            print('path convention is: {}'.format(self.conv_str))
-            raise Exception('path does not conform to convention: {}'.format(path))
+            raise ParseError(path, 'path', 'expected {} directory levels ({}), found {}'.format(
+                             len(self.conv_list), self.conv_str, len(values)))
         else:
             return dict(zip(self.conv_list,path.split(os.sep)))
 
+    def parse_list(self, pathes):
+        """Parses a list of pathes in bulk.
+
+        Args:
+            pathes (list): Directory pathes according to the convention.
+
+        Returns:
+            tuple: DataFrame of attributes for the pathes that conform
+            to the convention (indexed by position in the input list) and
+            an array of the rejected pathes.
+
+        """
+        pathes = pd.Series(pathes, dtype=object)
+        attrs, valid = match_list([self.compiled()], pathes)
+        attrs.columns = self.conv_list
+        return attrs, pathes[~valid].to_numpy()
+
+    def compiled(self):
+        """Returns the compiled :meth:`expression`, compiled once per root.
+        """
+        key = (self.root, tuple(self.conv_list))
+        if getattr(self, '_compiled', (None,))[0] != key:
+            self._compiled = (key, re.compile(self.expression()))
+        return self._compiled[1]
+
+    def expression(self):
+        """Returns a regular expression string matching pathes below the root.
+
+        Each directory level is captured in an unnamed group.
+        """
+        sep = re.escape(os.sep)
+        expression = sep.join('([^{}]*)'.format(sep) for key in self.conv_list)
+        if self.root:
+            expression = re.escape(os.path.join(self.root, '')) + expression
+        return expression
+
     def pattern(self, root=None, **kwargs):
         """Creates a path pattern from attributes.
         """
@@ -173,6 +497,28 @@ class FilePathConvention(NamingConvention):
         build_str = self._build_str(self.conv_list, **kwargs)
         return os.path.join(root, *build_str)
 
+    def levels(self, **kwargs):
+        """Returns the list of patterns for each directory level.
+
+        Attributes may have a list of values.
+        """
+        return [values(fill) for fill in self._build_str(self.conv_list, **kwargs)]
+
+    def prefixes(self, root=None, **kwargs):
+        """Returns the minimal set of directory prefixes to search.
+
+        The leading directory levels without wildcards are expanded
+        into all combinations of their values. Attributes may have a
+        list of values, e.g., ``prefixes(variable=['tas', 'pr'])``.
+
+        Returns:
+            list: directory prefixes below the root.
+
+        """
+        if root is None:
+            root = self.root
+        return _fixed_prefixes([root], 0, self.levels(**kwargs))[0]
+
 
 class FileConvention(object):
     """Combines a path and filename convention.
@@ -198,15 +544,79 @@ class FileConvention(object):
         """
         self.path_conv.root = root
 
+    @property
+    def attr_names(self):
+        """Returns the attribute names of path and filename convention.
+        """
+        names = list(self.path_conv.conv_list)
+        names += [a for a in self.filename_conv.attr_names if a not in names]
+        return names
+
     def parse(self, file):
         """Parses a file including path and filename and returns attributes.
         """
         path_attrs     = self.path_conv.parse(os.path.dirname(file))
         filename_attrs = self.filename_conv.parse(os.path.basename(file))
-        if filename_attrs:
-            path_attrs.update(filename_attrs)
+        if filename_attrs is None:
+            raise ParseError(file, 'filename', 'does not match {}'.format(self.filename_conv.conv_str))
+        path_attrs.update(filename_attrs)
         return path_attrs
 
+    def explain(self, files):
+        """Explains why files do not conform to the convention.
+
+        Returns:
+            DataFrame: the ``path``, the ``level`` of the convention that
+            failed and the ``reason`` for each file.
+
+        """
+        nlevels = len(self.path_conv.conv_list)
+        prefix  = os.path.join(self.root, '') if self.root else ''
+        records = []
+        for f in files:
+            if not f.startswith(prefix):
+                records.append((f, 'root', 'not below root {}'.format(self.root)))
+                continue
+            depth = f[len(prefix):].count(os.sep)
+            if depth != nlevels:
+                records.append((f, 'path', 'expected {} directory levels ({}), found {}'.format(
+                                nlevels, self.path_conv.conv_str, depth)))
+            elif self.filename_conv._match(f.rpartition(os.sep)[2]) is None:
+                records.append((f, 'filename', 'does not match {}'.format(self.filename_conv.conv_str)))
+            else:
+                records.append((f, 'filename', 'does not match the convention'))
+        return pd.DataFrame(records, columns=rejected_columns)
+
+    def parse_list(self, files):
+        """Parses a list of files including pathes in bulk.
+
+        Returns:
+            tuple: DataFrame of attributes including the ``path`` column
+            and an array of the rejected files.
+
+        """
+        files = pd.Series(files, dtype=object)
+        groups, valid = match_list(self.compiled(), files)
+        # filename attributes take precedence over path attributes
+        nlevels = len(self.path_conv.conv_list)
+        columns = dict(zip(self.path_conv.conv_list, range(nlevels)))
+        columns.update((key, nlevels + i) for i, key in enumerate(self.filename_conv.regex.groupindex))
+        df = groups[list(columns.values())]
+        df.columns = list(columns)
+        df = self.filename_conv.convert(df)
+        df['path'] = files[valid]
+        return df, files[~valid].to_numpy()
+
+    def compiled(self):
+        """Returns the expressions of path and filename, compiled once per root.
+        """
+        path_regex = self.path_conv.compiled()
+        if getattr(self, '_compiled', (None,))[0] is not path_regex:
+            path_expression = path_regex.pattern + re.escape(os.sep)
+            self._compiled = (path_regex, [re.compile(path_expression + regex.pattern) for regex in
+                                           (self.filename_conv._greedy_regex, self.filename_conv.regex)])
+        return self._compiled[1]
+
     def filename(self, **kwargs):
         """Create a filename pattern.
         """
@@ -226,6 +636,115 @@ class FileConvention(object):
             root = self.root
         return os.path.join(self.path(root=root,**kwargs),self.filename(**kwargs))
 
+    def format_frame(self, df):
+        """Creates a path relative to the root for each row of a DataFrame of attributes.
+        """
+        return self.path_conv.format_frame(df) + os.sep + self.filename_conv.format_frame(df)
+
+    def patterns(self, root=None, **kwargs):
+        """Creates path and filename patterns for attributes with lists of values.
+
+        Returns:
+            list: the patterns of all combinations of values.
+        """
+        patterns = [self.pattern(root=root, **f) for f in expand_filter(kwargs)]
+        return list(dict.fromkeys(patterns))
+
+
+
+def categorize(df, columns):
+    """Converts attribute columns of a DataFrame to categoricals.
+
+    Attributes are repeated for many files, so that storing them as
+    integer codes into a table of categories saves most of the memory.
+    """
+    for column in columns:
+        if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
+
+
+def unique_values(column):
+    """Returns the unique values of a column in order of appearance.
+
+    For categorical columns, only the integer codes are searched and
+    categories that do not appear in the column are ignored.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes  = pd.unique(column.cat.codes.to_numpy())
+        values = column.cat.categories.to_numpy()[codes[codes >= 0]]
+        if (codes < 0).any():
+            values = np.append(values, np.nan)
+        return values
+    return column.unique()
+
+
+class ColumnIndex(object):
+    """Inverted index of a DataFrame column.
+
+    The column is factorized into integer codes and the row positions
+    are sorted by code, so that the rows holding a value are found
+    without scanning the column. For categorical columns, the codes
+    of the categorical are used directly, other columns are factorized
+    with sorted values, so that ranges of values are ranges of codes.
+    """
+
+    def __init__(self, column):
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            self.codes   = column.cat.codes.to_numpy()
+            self.uniques = column.cat.categories
+        else:
+            self.codes, self.uniques = pd.factorize(column, sort=True)
+            self.uniques = pd.Index(self.uniques)
+        self.order  = np.argsort(self.codes, kind='stable')
+        self.bounds = np.searchsorted(self.codes[self.order], np.arange(len(self.uniques) + 1))
+        self.counts = np.diff(self.bounds)
+
+    def lookup(self, value):
+        """Returns the codes matching a query value and if the query is negated.
+
+        The value may be a single value, a list of values, a string with
+        wildcards (``*``, ``?``, ``[]``), a ``slice`` for an inclusive range
+        of values or a string starting with ``!`` for a negation.
+        """
+        if isinstance(value, str) and value.startswith('!'):
+            return self.lookup(value[1:])[0], True
+        if isinstance(value, slice):
+            mask = np.ones(len(self.uniques), dtype=bool)
+            if value.start is not None:
+                mask &= self.uniques >= value.start
+            if value.stop is not None:
+                mask &= self.uniques <= value.stop
+            return np.nonzero(mask)[0], False
+        if isinstance(value, str) and glob.has_magic(value):
+            names = self.uniques.astype(str)
+            return np.nonzero([fnmatch.fnmatchcase(n, value) for n in names])[0], False
+        if not isinstance(value, (list, tuple, set, np.ndarray, pd.Index)):
+            value = [value]
+        codes = self.uniques.get_indexer(list(value))
+        return np.unique(codes[codes >= 0]), False
+
+    def size(self, codes):
+        """Returns the number of rows holding one of the codes.
+        """
+        return self.counts[codes].sum()
+
+    def positions(self, codes):
+        """Returns the sorted row positions holding one of the codes.
+        """
+        if len(codes) == 0:
+            return np.empty(0, dtype=np.intp)
+        if len(codes) == 1:
+            # the stable sort keeps the positions of a code in order
+            return self.order[self.bounds[codes[0]]:self.bounds[codes[0] + 1]]
+        return np.sort(np.concatenate([self.order[self.bounds[c]:self.bounds[c + 1]] for c in codes]))
+
+    def contains(self, codes, positions):
+        """Returns a mask of the positions holding one of the codes.
+        """
+        table = np.zeros(len(self.uniques) + 1, dtype=bool)
+        table[codes + 1] = True
+        return table[self.codes[positions] + 1]
 
 
 class FileSelection(object):
@@ -233,17 +752,70 @@ class FileSelection(object):
 
     The pandas Dataframe holds a list of files
     that fullfill a convention and stores attributes
-    derived from the filename and path.
+    derived from the filename and path. The attributes
+    are usually stored as categoricals and the ``path``
+    column relative to the ``root`` directory.
+    Files that did not conform to the convention are listed
+    in the ``rejected`` table with the columns ``path``,
+    ``level`` and ``reason``.
     """
 
-    def __init__(self, df):
-        self.df = df
+    def __init__(self, df, root=None, rejected=None):
+        self.df   = df
+        self.root = root
+        if rejected is None:
+            rejected = pd.DataFrame(columns=rejected_columns)
+        self.rejected = rejected
+        self._cache = {}
+
+    def index(self, key):
+        """Returns the cached :class:`ColumnIndex` of an attribute.
+
+        The index is built on first use. The DataFrame of a selection
+        should not be modified in place once indices have been built.
+        """
+        if ('index', key) not in self._cache:
+            self._cache[('index', key)] = ColumnIndex(self.df[key])
+        return self._cache[('index', key)]
+
+    def query(self, **kwargs):
+        """Returns the row positions that fulfill the filter attributes.
+
+        The conditions are evaluated on the inverted indices of the
+        attributes, starting with the most selective one. The remaining
+        conditions are only checked for the rows that are left.
+        See :meth:`subset` for the query values.
+        """
+        conditions = []
+        for key, value in kwargs.items():
+            index = self.index(key)
+            codes, negate = index.lookup(value)
+            size = index.size(codes)
+            conditions.append((len(self.df) - size if negate else size, key, codes, negate))
+        conditions.sort(key=lambda c: c[0])
+        positive = [c for c in conditions if not c[3]]
+        if positive:
+            size, key, codes, negate = positive[0]
+            positions = self.index(key).positions(codes)
+            conditions.remove(positive[0])
+        else:
+            positions = np.arange(len(self.df))
+        for size, key, codes, negate in conditions:
+            if len(positions) == 0:
+                break
+            keep = self.index(key).contains(codes, positions)
+            positions = positions[~keep if negate else keep]
+        return positions
 
     def subset(self, **kwargs):
         """Create a subset by filtering attributes.
+
+        Each attribute may be filtered by a single value, a list of
+        values, a string with wildcards (e.g. ``variable='ta*'``), a
+        ``slice`` of an inclusive range (e.g. ``startdate=slice('1950', '1960')``)
+        or a negation starting with ``!`` (e.g. ``frequency='!fx'``).
         """
-        df = self.df[np.logical_and.reduce([(self.df[i] == j) for i, j in kwargs.items()])]
-        return FileSelection(df)
+        return FileSelection(self.df.iloc[self.query(**kwargs)], root=self.root, rejected=self.rejected)
 
     def __str__(self):
         text = ''
@@ -253,13 +825,47 @@ class FileSelection(object):
     def to_csv(self, filename):
         self.df.to_csv(filename)
 
+    def to_arrow(self):
+        """Converts the selection to a :class:`pyarrow.Table`.
+
+        Categorical attributes become dictionary encoded columns and
+        datetime columns keep their type. The root of the selection is
+        stored in the schema metadata.
+        """
+        pa = _import_pyarrow()
+        table = pa.Table.from_pandas(self.df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[_arrow_metadata_key] = json.dumps({'root': self.root})
+        return table.replace_schema_metadata(metadata)
+
+    def to_parquet(self, filename, **kwargs):
+        """Writes the selection to a Parquet file.
+
+        Keyword arguments are passed to :func:`pyarrow.parquet.write_table`.
+        The selection can be reloaded with :func:`read_selection`.
+        """
+        _import_pyarrow()
+        import pyarrow.parquet as pq
+        pq.write_table(self.to_arrow(), filename, **kwargs)
+
+    def to_feather(self, filename, **kwargs):
+        """Writes the selection to a Feather (Arrow IPC) file.
+
+        Keyword arguments are passed to :func:`pyarrow.feather.write_feather`.
+        The selection can be reloaded with :func:`read_selection`.
+        """
+        _import_pyarrow()
+        import pyarrow.feather as feather
+        feather.write_feather(self.to_arrow(), filename, **kwargs)
+
     def attributes(self):
         for key in self.df:
-            print('attribute {}, found {}'.format(key,self.df[key].unique()))
+            print('attribute {}, found {}'.format(key, unique_values(self.df[key])))
 
     @property
     def file_list(self):
-        #return list(self.df.index.values)
+        if self.root:
+            return [os.path.join(self.root, p) for p in self.df['path']]
         return list(self.df['path'].values)
 
     def __getitem__(self, key):
@@ -268,60 +874,648 @@ class FileSelection(object):
     def __iter__(self):
         return iter(self.df)
 
+    def checksums(self, algorithm='sha256', workers=8, column='checksum', instrument=None):
+        """Computes the checksums of all files in a pool of threads.
+
+        The checksums are stored in a column together with the ``size``
+        and ``mtime`` of each file at the time it was hashed. Files that
+        already have a checksum and whose size and modification time are
+        unchanged are not read again. Throughput is reported to the
+        ``instrument`` and logged.
+
+        Args:
+            algorithm (str): The hash algorithm, see :mod:`hashlib`.
+            workers (int): Number of threads reading files.
+            column (str): The column holding the checksums.
+            instrument (:class:`cordex.metrics.Instrument`): Receives the
+                hashed bytes and durations.
+
+        Returns:
+            :class:`FileSelection`: a copy of the selection with checksums.
+
+        """
+        instrument = metrics.get_instrument(instrument)
+        df = self.df.copy()
+        files = self.file_list
+        previous = df[column].to_numpy(dtype=object) if column in df else np.full(len(df), None, dtype=object)
+        sizes  = df['size'].to_numpy() if 'size' in df else np.full(len(df), -1)
+        mtimes = df['mtime'].to_numpy() if 'mtime' in df else np.full(len(df), np.nan)
+
+        def update(i):
+            st = os.stat(files[i])
+            if previous[i] is not None and not pd.isna(previous[i]) and \
+               st.st_size == sizes[i] and st.st_mtime == mtimes[i]:
+                return previous[i], st.st_size, st.st_mtime, 0
+            start = time.perf_counter()
+            digest = file_checksum(files[i], algorithm)
+            instrument.hashed(st.st_size, time.perf_counter() - start)
+            return digest, st.st_size, st.st_mtime, st.st_size
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(update, range(len(df))))
+        elapsed = time.perf_counter() - start
+        hashed = sum(r[3] for r in results)
+        _logger.info('hashed {:.1f} MB in {:.2f}s ({:.1f} MB/s), {} of {} files unchanged'.format(
+                     hashed / 1.e6, elapsed, hashed / 1.e6 / elapsed if elapsed else 0.0,
+                     sum(1 for r in results if r[3] == 0), len(results)))
+        df[column] = [r[0] for r in results]
+        df['size'] = np.array([r[1] for r in results], dtype=np.int64)
+        df['mtime'] = np.array([r[2] for r in results], dtype=np.float64)
+        return type(self)(df, root=self.root, rejected=self.rejected)
+
+    def verify(self, column='checksum', algorithm='sha256', workers=8, instrument=None):
+        """Verifies the files against the checksums of a column.
+
+        All files are hashed again, e.g., to verify the checksums of a
+        search before publishing.
+
+        Returns:
+            DataFrame: the rows of the files whose checksum differs.
+
+        """
+        current = FileSelection(self.df.drop(columns=[column]), root=self.root)
+        current = current.checksums(algorithm, workers, column, instrument)
+        mismatch = current.df[column].to_numpy() != self.df[column].astype(str).str.lower().to_numpy()
+        return self.df[mismatch]
+
+
+_arrow_metadata_key = b'cordex'
+
+
+def _import_pyarrow():
+    """Imports pyarrow, which is only required for columnar files.
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception('pyarrow is required for Parquet and Feather files, '
+                        'install it with: pip install cordex[arrow]')
+    return pyarrow
+
+
+def _filter_expression(filter):
+    """Translates filter attributes to a :mod:`pyarrow.dataset` expression.
+
+    Single values, lists of values, ranges given by a ``slice`` and
+    negations starting with ``!`` are translated. Values with wildcards
+    can not be pushed down and are returned as residual filter.
+
+    Returns:
+        tuple: the expression (``None`` if there is none) and the
+        residual filter.
+
+    """
+    import pyarrow.dataset as ds
+    expression, residual = None, {}
+    for key, value in filter.items():
+        field = ds.field(key)
+        if isinstance(value, slice):
+            condition = None
+            if value.start is not None:
+                condition = field >= value.start
+            if value.stop is not None:
+                stop = field <= value.stop
+                condition = stop if condition is None else condition & stop
+            if condition is None:
+                continue
+        elif isinstance(value, str) and glob.has_magic(value):
+            residual[key] = value
+            continue
+        elif isinstance(value, str) and value.startswith('!'):
+            condition = ~field.isin([value[1:]])
+        else:
+            condition = field.isin(values(value))
+        expression = condition if expression is None else expression & condition
+    return expression, residual
 
-def make_df(convention, files):
+
+def arrow_format(filename):
+    """Returns the :mod:`pyarrow.dataset` format of a Parquet or Feather file.
+    """
+    return 'parquet' if os.path.splitext(filename)[1] in ('.parquet', '.pq') else 'ipc'
+
+
+def join_columns(a, b):
+    """Joins two columns with one hash table.
+
+    Both columns are factorized in one pass, so that large columns of
+    strings are joined without sorting or Python sets.
+
+    Returns:
+        tuple: position of each value of ``b`` in ``a`` (``-1`` if it
+        is missing) and the mask of values of ``a`` found in ``b``.
+
+    """
+    codes, uniques = pd.factorize(np.concatenate([np.asarray(a, dtype=object),
+                                                  np.asarray(b, dtype=object)]))
+    lookup = np.full(len(uniques), -1, dtype=np.intp)
+    lookup[codes[:len(a)]] = np.arange(len(a))
+    positions = lookup[codes[len(a):]]
+    matched = np.zeros(len(a), dtype=bool)
+    matched[positions[positions >= 0]] = True
+    return positions, matched
+
+
+def read_selection(filename, columns=None, filter={}, format=None, cls=None):
+    """Reads a selection from a Parquet or Feather file.
+
+    Only the requested columns are read and the filter is pushed down
+    to the file reader, so that row groups that can not match the filter
+    are skipped (see :meth:`FileSelection.subset` for the filter values).
+    Attribute columns are restored as categoricals.
+
+    Args:
+        filename (str): The Parquet or Feather file.
+        columns (list): The columns to read. If ``None``, all columns
+            are read.
+        filter (dict): Defines attributes to filter the files.
+        format (str): ``'parquet'`` or ``'feather'``. If ``None``, the
+            format is guessed from the file extension.
+        cls (type): The selection class, defaults to :class:`FileSelection`.
+
+    Returns:
+        :class:`FileSelection` object.
+
+    """
+    _import_pyarrow()
+    import pyarrow.dataset as ds
+    if format is None:
+        format = arrow_format(filename)
+    if format == 'feather':
+        format = 'ipc'
+    cls = cls or FileSelection
+    dataset = ds.dataset(filename, format=format)
+    expression, residual = _filter_expression(filter)
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + list(residual)))
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    metadata = (dataset.schema.metadata or {}).get(_arrow_metadata_key)
+    root = json.loads(metadata).get('root') if metadata else None
+    selection = cls(df, root=root)
+    if residual:
+        selection = selection.subset(**residual)
+    return selection
+
+
+def _parse_shard(convention, files):
+    """Parses a shard of a file list, used by the worker processes.
+    """
+    return convention.parse_list(files)
+
+
+def parse_files(convention, files, workers=None):
+    """Parses a list of files, optionally using a pool of processes.
+
+    The file list is split into one shard per worker. The shards are
+    parsed independently and the resulting DataFrames are concatenated,
+    so that results are transferred column-wise rather than row by row.
+
+    Args:
+        convention (:class:`FileConvention`): The convention used for parsing.
+        files (list): The files to parse.
+        workers (int): Number of worker processes. If ``None``, the
+            files are parsed in the current process.
+
+    Returns:
+        tuple: DataFrame of attributes and an array of the rejected files.
+
+    """
+    if not workers or workers <= 1 or len(files) < 2 * workers:
+        return convention.parse_list(files)
+    shards = np.array_split(np.asarray(files, dtype=object), workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_parse_shard, [convention] * len(shards), shards))
+    # restore the positions in the complete file list
+    offsets = np.cumsum([0] + [len(shard) for shard in shards[:-1]])
+    for (df, rejected), offset in zip(results, offsets):
+        df.index += offset
+    df = pd.concat([r[0] for r in results])
+    rejected = np.concatenate([r[1] for r in results])
+    return df, rejected
+
+
+def make_df(convention, files, workers=None, instrument=None, errors='collect'):
     """Creates a Pandas DataFrame object from convention and files.
 
     This function creates a Pandas DataFrame object by parsing a list
     of files according to a convention of type :class:`FileConvention`.
+    See :func:`make_table` for the arguments.
     """
-    df = pd.DataFrame()
+    return make_table(convention, files, workers, instrument, errors)[0]
+
+
+def make_table(convention, files, workers=None, instrument=None, errors='collect'):
+    """Creates a Pandas DataFrame object and a table of rejected files.
+
+    If ``workers`` is given, the files are parsed by a pool of processes
+    (see :func:`parse_files`).
+
+    The files are expected to exist, e.g., as returned by :func:`select_files`.
+    Attributes are stored as categoricals and pathes relative to the
+    root of the convention.
+    If ``files`` is a DataFrame with a ``path`` column, its other columns
+    (like ``size`` and ``mtime``) are added to the result.
+    Parsing time and rejected files are reported to the ``instrument``
+    (see :mod:`cordex.metrics`).
+
+    Args:
+        convention (:class:`FileConvention`): The convention used for parsing.
+        files (list): The files to parse.
+        workers (int): Number of processes used for parsing the files.
+        instrument (:class:`cordex.metrics.Instrument`): Receives parse metrics.
+        errors (str): Policy for files that do not conform to the
+            convention, see :func:`handle_rejected`.
+
+    Returns:
+        tuple: DataFrame of attributes and DataFrame of rejected files.
+
+    """
+    instrument = metrics.get_instrument(instrument)
     l = len(files)
     if l == 0:
         logging.error('file list is empty')
         raise Exception('can not create dataframe from empty file list.')
-    print('parsing {} files...\n'.format(l))
-    #printProgressBar(0, l, prefix = 'Parsing files, Progress:', suffix = 'Complete', length = 50)
-    for i,f in enumerate(files):
-        _logger.debug('parsing file: {}'.format(f))
-        if not os.path.isfile(f):
-            _logger.warning('ignoring {}'.format(f))
-            continue
-        attrs = convention.parse(f)
-        attrs['path'] = f
-        #df = pd.concat([df, pd.DataFrame(attrs, index=[f])])
-        #df = pd.concat([df, pd.DataFrame(attrs)], ignore_index=True).reset_index(drop=True)
-        df = df.append(attrs, ignore_index=True)
-        #printProgressBar(i + 1, l, prefix = 'Progress:', \
-        #                 suffix = 'Complete', length = 50)
-    return df
+    _logger.info('parsing {} files...'.format(l))
+    if isinstance(files, pd.DataFrame):
+        extra = files.drop(columns='path').reset_index(drop=True)
+        files = files['path'].tolist()
+    else:
+        extra = None
+    start = time.perf_counter()
+    df, rejected = parse_files(convention, files, workers)
+    instrument.parsed(l, time.perf_counter() - start)
+    instrument.rejected(len(rejected))
+    rejected = handle_rejected(convention, rejected, errors)
+    if extra is not None:
+        df = df.join(extra)
+    if convention.root:
+        df['path'] = df['path'].str.slice(len(os.path.join(convention.root, '')))
+    return categorize(df.reset_index(drop=True), convention.attr_names), rejected
+
+
+def _match_name(name, pattern):
+    """Matches a directory entry name like :mod:`glob` does.
+    """
+    if name.startswith('.') and not pattern.startswith('.'):
+        return False
+    return fnmatch.fnmatchcase(name, pattern)
 
 
-def select_files(convention, filter={}, root=None, ignore_path=False):
-    """Creates a file list by searching the filesystem.
+def version_numbers(versions):
+    """Converts version strings like ``'v20190925'`` to numbers.
+
+    Versions that can not be converted become ``NaN``.
+    """
+    versions = pd.Series(versions)
+    if isinstance(versions.dtype, pd.CategoricalDtype):
+        numbers = version_numbers(versions.cat.categories).to_numpy()
+        return pd.Series(np.append(numbers, np.nan)[versions.cat.codes.to_numpy()], index=versions.index)
+    return pd.to_numeric(versions.astype(str).str.lstrip('v'), errors='coerce')
+
+
+def _newest(entries):
+    """Returns the entries of the newest version directory.
+    """
+    numbers = version_numbers([e.name for e in entries]).to_numpy()
+    if len(entries) == 0 or np.isnan(numbers).all():
+        return entries
+    return [entries[int(np.nanargmax(numbers))]]
+
 
-    The file list is created by using a search pattern according to a
-    :class:`FileConvention`, :class:`FileNameConvention` or
-    :class:`FilePathConvention`.
+class _Walker(object):
+    """Decides which directories and files are traversed by a crawler.
+
+    Filter attributes may have lists of values. Each directory is
+    visited at most once, regardless of the number of values. Versions
+    are only pruned if ``version`` is the last level of the path
+    convention, otherwise a newer version directory may lack variables
+    that are only found in older versions.
+    """
+
+    def __init__(self, convention, filter={}, root=None, latest=False):
+        if root:
+            convention.root = root
+        self.path_conv = convention.path_conv
+        if latest and 'version' not in self.path_conv.conv_list:
+            raise Exception('latest requires a version level in the path convention, '
+                            'got {}'.format(self.path_conv.conv_list))
+        self.levels    = self.path_conv.levels(**filter)
+        self.filenames = list(dict.fromkeys(convention.filename(**f) for f in expand_filter(filter)))
+        self.latest    = latest and self.path_conv.conv_list[-1] == 'version'
+        if latest and not self.latest:
+            _logger.debug('version is not the last path level, all versions are traversed')
+
+    def descend(self, path, level):
+        """Enters levels with fixed values without listing them.
+
+        Returns:
+            list: the next (path, level) pairs that have to be listed.
+        """
+        paths, level = _fixed_prefixes([path], level, self.levels)
+        return [(path, level) for path in paths]
+
+    def start(self):
+        return self.descend(self.path_conv.root, 0)
+
+    def expand(self, path, level, entries):
+        """Selects the subdirectories and files from a directory listing.
+
+        Returns:
+            tuple: list of (path, level) of subdirectories to list
+            and list of (filename, entry) of matching files.
+        """
+        if level < len(self.levels):
+            entries = [e for e in entries if e.is_dir() and
+                       any(_match_name(e.name, p) for p in self.levels[level])]
+            if self.latest and self.path_conv.conv_list[level] == 'version':
+                entries = _newest(entries)
+            dirs = []
+            for e in entries:
+                dirs.extend(self.descend(os.path.join(path, e.name), level + 1))
+            return dirs, []
+        return [], [(os.path.join(path, e.name), e) for e in entries
+                    if e.is_file() and any(_match_name(e.name, p) for p in self.filenames)]
+
+
+def _listdir(scandir, path, instrument=metrics.NULL):
+    """Lists a directory, missing directories are empty.
+
+    Directories that can not be read, e.g., without permission, are
+    skipped like by :func:`glob.glob` and reported to the instrument.
+
+    Returns:
+        tuple: list of entries, ``None`` if the directory can not be
+        read, and the latency of the listing in seconds.
+    """
+    start = time.perf_counter()
+    try:
+        with scandir(path or os.curdir) as it:
+            entries = list(it)
+    except (FileNotFoundError, NotADirectoryError):
+        entries = []
+    except OSError as e:
+        _logger.debug('skipping unreadable directory {}: {}'.format(path, e))
+        instrument.failed(path, e)
+        entries = None
+    return entries, time.perf_counter() - start
+
+
+def crawl(convention, filter={}, root=None, scandir=os.scandir, latest=False, instrument=None):
+    """Walks the directory tree of a convention and yields matching files.
+
+    The directory levels of the path convention are traversed with
+    ``scandir``, so that the type of each entry is known from the
+    directory listing and no additional ``stat`` is required per file.
+    Levels with fixed values in the filter are not listed at all.
 
     Args:
         convention (:class:`FileConvention`): The convention used for
             browsing the file system.
+        filter (dict): Defines attributes to filer the search. Attributes
+            may have a list of values.
+        root (str): The root directory where the convention holds.
+        scandir (callable): Function used for listing directories.
+        latest (bool): Only traverse the newest directory on the
+            ``version`` level if it is the last level of the path
+            convention, e.g., for CORDEX. Otherwise, all versions are
+            traversed and :meth:`ESGF.ESGFFileSelection.latest` decides
+            per dataset. Conventions without a ``version`` level raise.
+        instrument (:class:`cordex.metrics.Instrument`): Receives the
+            directory listings and matched files.
+
+    Yields:
+        tuple: the full filename and its :class:`os.DirEntry`.
+
+    """
+    instrument = metrics.get_instrument(instrument)
+    walker = _Walker(convention, filter, root, latest)
+    stack = walker.start()
+    while stack:
+        path, level = stack.pop()
+        entries, seconds = _listdir(scandir, path, instrument)
+        entries = entries or []
+        instrument.listed(path, level, len(entries), seconds)
+        dirs, files = walker.expand(path, level, entries)
+        instrument.matched(len(files))
+        stack.extend(dirs)
+        for f in files:
+            yield f
+
+
+async def crawl_async(convention, filter={}, root=None, scandir=os.scandir, latest=False,
+                      concurrency=64, instrument=None, errors='skip'):
+    """Crawls the directory tree of a convention asynchronously.
+
+    Directory listings are run in a pool of ``concurrency`` threads, so
+    that many listings are in flight at the same time. This helps on
+    filesystems where each listing has a high latency. The files of each
+    listed directory are parsed in bulk and streamed to the caller.
+
+    Example:
+
+        Records can be collected, e.g., by::
+
+            async def collect():
+                return [record async for record in crawl_async(convention)]
+
+            records = asyncio.run(collect())
+
+    Args:
+        convention (:class:`FileConvention`): The convention used for
+            browsing and parsing.
         filter (dict): Defines attributes to filer the search.
         root (str): The root directory where the convention holds.
+        scandir (callable): Function used for listing directories.
+        latest (bool): Only traverse the newest version directories,
+            see :func:`crawl`.
+        concurrency (int): Maximum number of directory listings in flight.
+        instrument (:class:`cordex.metrics.Instrument`): Receives the
+            directory listings, matched, rejected and parsed files.
+        errors (str): Policy for files that do not conform to the
+            convention, ``'skip'`` or ``'raise'`` (see :func:`handle_rejected`).
+
+    Yields:
+        dict: attributes of a file including its full ``path``.
+
+    """
+    if errors not in ('skip', 'raise'):
+        raise Exception('crawl_async can not collect rejected files, use errors=\'skip\' or \'raise\'')
+    instrument = metrics.get_instrument(instrument)
+    walker  = _Walker(convention, filter, root, latest)
+    loop    = asyncio.get_running_loop()
+    waiting = walker.start()
+    pending = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while waiting or pending:
+            while waiting and len(pending) < concurrency:
+                path, level = waiting.pop()
+                future = loop.run_in_executor(executor, _listdir, scandir, path, instrument)
+                pending[future] = (path, level)
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                path, level = pending.pop(future)
+                entries, seconds = future.result()
+                entries = entries or []
+                instrument.listed(path, level, len(entries), seconds)
+                dirs, files = walker.expand(path, level, entries)
+                waiting.extend(dirs)
+                if not files:
+                    continue
+                instrument.matched(len(files))
+                start = time.perf_counter()
+                df, rejected = convention.parse_list([f for f, entry in files])
+                instrument.parsed(len(files), time.perf_counter() - start)
+                instrument.rejected(len(rejected))
+                handle_rejected(convention, rejected, errors)
+                for record in df.to_dict('records'):
+                    yield record
+
+
+def _sample_dir(scandir, path, max_entries):
+    """Lists at most ``max_entries`` visible entries of a directory.
+    """
+    entries = []
+    try:
+        with scandir(path) as it:
+            for entry in it:
+                if not entry.name.startswith('.'):
+                    entries.append(entry)
+                if len(entries) >= max_entries:
+                    break
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return entries
+
+
+def sample_files(root, walks=32, max_entries=64, max_depth=16, timeout=0.5, seed=None,
+                 scandir=os.scandir):
+    """Samples files from a directory tree by random walks.
+
+    Each walk starts at the root and descends into a randomly chosen
+    subdirectory until it reaches a directory without subdirectories.
+    At most ``max_entries`` entries are read from each directory and each
+    directory is listed only once, so that the cost does not depend on
+    the size of the tree. From each visited directory, one file is sampled.
+
+    Args:
+        root (str): The root directory.
+        walks (int): Number of random walks.
+        max_entries (int): Maximum number of entries read per directory.
+        max_depth (int): Maximum depth of a walk.
+        timeout (float): No new walks are started after ``timeout`` seconds.
+        seed (int): Seed of the random walks.
+        scandir (callable): Function used for listing directories.
 
     Returns:
-        List of full filenames.
+        list: the sampled files.
 
     """
-    if root:
-        convention.root = root
-    pattern = convention.pattern(**filter)
-    logging.info('looking for files: {}'.format(pattern))
-    return glob.glob(pattern)
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    listings = {}
+    files = set()
+    for walk in range(walks):
+        if time.perf_counter() - start > timeout:
+            _logger.debug('sampling stopped after {} walks'.format(walk))
+            break
+        path = root
+        for depth in range(max_depth + 1):
+            if path not in listings:
+                entries = _sample_dir(scandir, path, max_entries)
+                listings[path] = ([e.name for e in entries if e.is_dir()],
+                                  [e.name for e in entries if e.is_file()])
+            dirs, names = listings[path]
+            if names:
+                files.add(os.path.join(path, rng.choice(names)))
+            if not dirs:
+                break
+            path = os.path.join(path, rng.choice(dirs))
+    return sorted(files)
+
+
+Detection = namedtuple('Detection', ['convention', 'confidence', 'scores'])
+Detection.__doc__ = """Result of :func:`detect`.
+
+The ``convention`` is the best matching convention instance (``None`` if no
+sampled file could be parsed), ``confidence`` the fraction of sampled files it could
+parse and ``scores`` the fraction for each convention by name.
+"""
+
+
+def detect(root, conventions, **kwargs):
+    """Detects the convention of a directory tree.
 
+    Files are sampled by random walks (see :func:`sample_files`) and parsed
+    by each convention. The convention that parses most of the sampled
+    files is returned, the first one of the list if scores are equal.
+
+    Args:
+        root (str): The root directory of the archive.
+        conventions (list): Convention classes or instances to test.
+        **kwargs: Passed to :func:`sample_files`.
+
+    Returns:
+        :class:`Detection` of the best convention.
 
-def get_selection(convention, filter={}, root=None, ignore_path=False):
+    """
+    files = sample_files(root, **kwargs)
+    best, confidence, scores = None, 0.0, {}
+    for convention in conventions:
+        if isinstance(convention, type):
+            convention = convention(root=root)
+        else:
+            convention.root = root
+        name = getattr(convention, 'name', type(convention).__name__)
+        if files:
+            df, rejected = convention.parse_list(files)
+            scores[name] = 1.0 - len(rejected) / len(files)
+        else:
+            scores[name] = 0.0
+        if files and (best is None or scores[name] > confidence):
+            best, confidence = convention, scores[name]
+    _logger.info('detected convention {} with confidence {:.2f} from {} files'.format(
+                 getattr(best, 'name', None), confidence, len(files)))
+    return Detection(best, confidence, scores)
+
+
+def select_files(convention, filter={}, root=None, ignore_path=False, stat=False, latest=False,
+                 instrument=None):
+    """Creates a file list by searching the filesystem.
+
+    The file list is created by crawling the filesystem according to a
+    :class:`FileConvention` (see :func:`crawl`).
+
+    Args:
+        convention (:class:`FileConvention`): The convention used for
+            browsing the file system.
+        filter (dict): Defines attributes to filer the search.
+        root (str): The root directory where the convention holds.
+        stat (bool): Also return size and modification time of each file.
+        latest (bool): Only search the newest version directories.
+        instrument (:class:`cordex.metrics.Instrument`): Receives crawl
+            metrics and the bytes of statted files.
+
+    Returns:
+        List of full filenames or, if ``stat`` is ``True``, a DataFrame
+        with the columns ``path``, ``size`` and ``mtime``.
+
+    """
+    logging.info('looking for files in {} with filter: {}'.format(root or convention.root, filter))
+    instrument = metrics.get_instrument(instrument)
+    files = crawl(convention, filter, root, latest=latest, instrument=instrument)
+    if not stat:
+        return [path for path, entry in files]
+    records = []
+    for path, entry in files:
+        st = entry.stat()
+        instrument.statted(st.st_size)
+        records.append((path, st.st_size, st.st_mtime))
+    return pd.DataFrame(records, columns=['path', 'size', 'mtime'])
+
+
+def get_selection(convention, filter={}, root=None, ignore_path=False, catalog=None, workers=None,
+                  stat=False, latest=False, instrument=None, errors='collect'):
     """Top level function to create a :class:`FileSelection` instance.
 
     This function creates a :class:`FileSelection` instance
@@ -332,12 +1526,25 @@ def get_selection(convention, filter={}, root=None, ignore_path=False):
             browsing the file system.
         filter (dict): Defines attributes to filer the search.
         root (str): The root directory where the convention holds.
+        catalog (:class:`cordex.catalog.FileCatalog`): If given, the
+            selection is queried from the catalog instead of the filesystem.
+        workers (int): Number of processes used for parsing the files.
+        stat (bool): Add the ``size`` and ``mtime`` of each file.
+        latest (bool): Only search the newest version directories.
+        instrument (:class:`cordex.metrics.Instrument`): Receives crawl
+            and parse metrics, see :mod:`cordex.metrics`.
+        errors (str): Policy for files that do not conform to the
+            convention, see :func:`handle_rejected`. Collected files are
+            available as ``rejected`` table of the selection.
 
     Returns:
         :class:`FileSelection` object.
 
     """
-    files = select_files(convention, filter, root, ignore_path)
-    df    = make_df(convention, files)
-    return FileSelection(df)
+    if catalog is not None:
+        return FileSelection(catalog.query(**filter), root=catalog.root)
+    files = select_files(convention, filter, root, ignore_path, stat=stat, latest=latest,
+                         instrument=instrument)
+    df, rejected = make_table(convention, files, workers=workers, instrument=instrument, errors=errors)
+    return FileSelection(df, root=convention.root or None, rejected=rejected)
 
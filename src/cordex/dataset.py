@@ -1,18 +1,235 @@
 
 
-from netCDF4 import Dataset, MFDataset, date2index, num2date, date2num
+import os
+import glob
+import weakref
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from netCDF4 import Dataset, MFDataset, num2date, date2num
+import numpy as np
+import pandas as pd
 import xarray as xr
 
 
+# tolerance of exact date lookups in units of the time axis
+_time_tolerance = 1.e-6
+
+
+class HandlePool():
+    """Thread-safe pool of open netCDF file handles.
+
+    Files are opened read-only on first use and stay open after they are
+    released, so that jumping between files does not reopen them. Each
+    handle counts its users, unused handles are closed in least recently
+    used order if more than ``maxsize`` files are open. Handles in use are
+    never closed, so the pool may temporarily exceed ``maxsize``.
+
+    The pool only guards the handles, reading the same handle from several
+    threads at once still needs a lock since netCDF4 is not thread-safe.
+
+    Args:
+        maxsize (int): The maximum number of open files.
+
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize  = maxsize
+        self._lock    = threading.Lock()
+        self._handles = OrderedDict()
+        self._refs    = {}
+        self._keys    = {}
+
+    def __len__(self):
+        return len(self._handles)
+
+    @staticmethod
+    def key(filename, **kwargs):
+        if isinstance(filename, (list, tuple)):
+            filename = tuple(os.path.abspath(f) for f in filename)
+        else:
+            filename = os.path.abspath(filename)
+        return (filename, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+
+    @staticmethod
+    def open(filename, **kwargs):
+        if isinstance(filename, (list, tuple)):
+            return MFDataset(list(filename), **kwargs)
+        return Dataset(filename, **kwargs)
+
+    def acquire(self, filename, **kwargs):
+        """Returns an open handle of a file and counts its use.
+
+        Args:
+            filename (str): The file to open, a list of files is opened
+                as :class:`netCDF4.MFDataset`.
+            **kwargs: Passed to :class:`netCDF4.Dataset`.
+
+        Returns:
+            the open dataset, has to be passed to :meth:`release`.
+
+        """
+        if kwargs.get('mode', 'r') != 'r':
+            raise Exception('only files opened for reading can be pooled')
+        key = self.key(filename, **kwargs)
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None:
+                return self._use(key, handle)
+        # open outside the lock, opening may be slow on parallel filesystems
+        handle = self.open(filename, **kwargs)
+        with self._lock:
+            if key in self._handles:
+                # opened by another thread meanwhile
+                handle.close()
+                handle = self._handles[key]
+            else:
+                self._handles[key] = handle
+                self._refs[key] = 0
+                self._keys[id(handle)] = key
+            handle = self._use(key, handle)
+            self._evict()
+        return handle
+
+    def _use(self, key, handle):
+        self._refs[key] += 1
+        self._handles.move_to_end(key)
+        return handle
+
+    def release(self, handle):
+        """Releases a handle returned by :meth:`acquire`.
+        """
+        with self._lock:
+            key = self._keys.get(id(handle))
+            if key is None:
+                raise Exception('handle is not in the pool: {}'.format(handle))
+            self._refs[key] -= 1
+            self._evict()
+
+    def _evict(self):
+        unused = [key for key in self._handles if self._refs[key] == 0]
+        for key in unused[:max(len(self._handles) - self.maxsize, 0)]:
+            self._close(key)
+
+    def _close(self, key):
+        handle = self._handles.pop(key)
+        del self._refs[key]
+        del self._keys[id(handle)]
+        handle.close()
+
+    @contextmanager
+    def handle(self, filename, **kwargs):
+        """Context manager that acquires and releases a handle.
+        """
+        handle = self.acquire(filename, **kwargs)
+        try:
+            yield handle
+        finally:
+            self.release(handle)
+
+    def resize(self, maxsize):
+        """Sets the maximum number of open files.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        """Closes all unused handles, e.g., after files were rewritten.
+        """
+        with self._lock:
+            for key in [key for key in self._handles if self._refs[key] == 0]:
+                self._close(key)
+
+
+# process wide pool shared by all datasets
+pool = HandlePool()
+
+
+def set_max_open_files(maxsize):
+    """Sets the maximum number of files kept open by the :data:`pool`.
+    """
+    pool.resize(maxsize)
+
+
+class TimeAxisIndex():
+    """Sorted index of the numeric values of a time axis.
+
+    The time axis is read and decoded once, date lookups are
+    binary searches in the sorted values.
+    """
+
+    def __init__(self, values, units, calendar):
+        self.units    = units
+        self.calendar = calendar
+        self.values   = np.asarray(values, dtype=np.float64)
+        self.order    = np.argsort(self.values, kind='stable')
+        self.sorted   = self.values[self.order]
+
+    def __len__(self):
+        return len(self.values)
+
+    def lookup(self, nums, select='exact'):
+        """Returns the indices of numeric time values.
+
+        Args:
+            nums (array): Numeric time values in the units of the axis.
+            select (str): ``'exact'`` requires a time step at each value,
+                ``'before'`` and ``'after'`` return the closest time step
+                before or after and ``'nearest'`` the closest one
+                (like :func:`netCDF4.date2index`).
+
+        Returns:
+            array: indices of the time steps.
+
+        """
+        nums = np.atleast_1d(np.asarray(nums, dtype=np.float64))
+        n = len(self.sorted)
+        right = np.searchsorted(self.sorted, nums - _time_tolerance, side='left')
+        if select == 'exact':
+            pos = np.minimum(right, n - 1)
+            if n == 0 or np.any(np.abs(self.sorted[pos] - nums) > _time_tolerance):
+                raise ValueError('some of the dates specified were not found in the time axis')
+        elif select == 'after':
+            pos = right
+            if np.any(pos >= n):
+                raise ValueError('some of the dates specified are after the last time step')
+        elif select == 'before':
+            pos = np.searchsorted(self.sorted, nums + _time_tolerance, side='right') - 1
+            if np.any(pos < 0):
+                raise ValueError('some of the dates specified are before the first time step')
+        elif select == 'nearest':
+            upper = np.minimum(right, n - 1)
+            lower = np.maximum(right - 1, 0)
+            pos = np.where(np.abs(self.sorted[lower] - nums) <= np.abs(self.sorted[upper] - nums),
+                           lower, upper)
+        else:
+            raise ValueError('select must be one of exact, before, after or nearest')
+        return self.order[pos]
+
+
 class NC4Dataset():
 
     def __init__(self, file_list=None, ds=None, time_axis='time', **kwargs):
         self.time_axis = time_axis
-        if file_list:
+        self._time_index = None
+        self._release = None
+        if file_list and kwargs.get('mode', 'r') == 'r':
+            self._acquire(file_list, **kwargs)
+        elif file_list:
+            # files opened for writing are not shared
             self.ds = Dataset(file_list, **kwargs)
         else:
             self.ds = ds
 
+    def _acquire(self, file_list, **kwargs):
+        """Acquires the handle from the :data:`pool`, it is released
+        by :meth:`close` or when the dataset is garbage collected.
+        """
+        self.ds = pool.acquire(file_list, **kwargs)
+        self._release = weakref.finalize(self, pool.release, self.ds)
+
     def __str__(self):
         return str(self.ds)
 
@@ -29,11 +246,31 @@ class NC4Dataset():
         return self.ds.variables
 
     def __getattr__(self, item):
+        if item in ('ds', '_time_index', '_release'):
+            raise AttributeError(item)
         return getattr(self.ds, item)
 
+    @property
+    def time_index(self):
+        """The :class:`TimeAxisIndex` of the time axis, decoded on first use.
+        """
+        if getattr(self, '_time_index', None) is None:
+            time = self.ds.variables[self.time_axis]
+            values = np.ma.filled(time[:].astype(np.float64), np.nan)
+            self._time_index = TimeAxisIndex(values, self.units, self.calendar)
+        return self._time_index
+
     def ncattrs(self):
         return self.ds.ncattrs()
 
+    def close(self):
+        """Releases the file handle to the :data:`pool` or closes it.
+        """
+        if self._release is not None:
+            self._release()
+        else:
+            self.ds.close()
+
     def ncattrs_dict(self, varname=None):
         if varname:
             return {attr:self.ds.variables[varname].getncattr(attr)
@@ -42,9 +279,21 @@ class NC4Dataset():
             return {attr:self.ds.getncattr(attr)
                     for attr in self.ds.ncattrs()}
 
-    def get_index_by_date(self, dates):
-        return date2index(dates,
-                self.ds.variables[self.time_axis], select='exact')
+    def get_index_by_date(self, dates, select='exact'):
+        """Returns the time index of a date or a list of dates.
+        """
+        indices = self.get_index_by_dates(dates, select)
+        if np.ndim(dates) == 0:
+            return int(indices[0])
+        return indices
+
+    def get_index_by_dates(self, dates, select='exact'):
+        """Returns the time indices of an array of dates.
+
+        The dates are converted to numbers at once and looked up in the
+        cached :attr:`time_index`.
+        """
+        return self.time_index.lookup(self.get_num_by_date(dates), select)
 
     def get_date_by_num(self, nums):
         return num2date(nums, self.units, calendar=self.calendar)
@@ -53,11 +302,10 @@ class NC4Dataset():
         return date2num(dates, self.units, calendar=self.calendar)
 
     def get_num_by_index(self, index):
-        return self.variables[self.time_axis][index]
+        return self.time_index.values[index]
 
     def get_date_by_index(self, index):
-        num = self.ds.variables[self.time_axis][index]
-        return self.get_date_by_num(num)
+        return self.get_date_by_num(self.get_num_by_index(index))
 
     def get_timestep(self, date, varname):
         ix = self.get_index_by_date(date)
@@ -106,7 +354,10 @@ class NC4MFDataset(NC4Dataset):
 
     def __init__(self, file_list, time_axis='time', **kwargs):
         self.time_axis = time_axis
-        self.ds = MFDataset(file_list, **kwargs)
+        self._time_index = None
+        if isinstance(file_list, str):
+            file_list = sorted(glob.glob(file_list))
+        self._acquire(list(file_list), **kwargs)
 
     def ncattrs_dict(self, varname=None):
         if varname:
@@ -121,6 +372,150 @@ class NC4MFDataset(NC4Dataset):
 
 
 
+def date_keys(dates):
+    """Converts dates to sortable integer keys ``YYYYmmddHHMMSS``.
+
+    The keys only use the fields of the dates, so that they can be
+    compared for all calendars, e.g., ``360_day`` dates from :mod:`cftime`.
+    """
+    dates = np.atleast_1d(np.asarray(dates, dtype=object))
+    return np.array([((((d.year * 100 + d.month) * 100 + d.day) * 100 + d.hour) * 100 + d.minute) * 100
+                     + d.second for d in dates], dtype=np.int64)
+
+
+def filename_keys(dates, fill):
+    """Converts date strings of filenames to keys like :func:`date_keys`.
+
+    Missing digits are filled with ``fill``, i.e., ``'0'`` for the start
+    and ``'9'`` for the end of a period, so that e.g. ``'195012'`` ends
+    after the last time step of December 1950 for all calendars.
+
+    Datetime columns, e.g., from :meth:`ESGF.ESGFFileSelection.to_datetime`
+    are converted field by field. Enddates are expected to be snapped to
+    the end of their period like in :meth:`ESGF.ESGFFileSelection.select_timerange`.
+    """
+    dates = pd.Series(dates)
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        keys = np.zeros(len(dates), dtype=np.int64)
+        for field in ('year', 'month', 'day', 'hour', 'minute', 'second'):
+            keys = keys * 100 + getattr(dates.dt, field).to_numpy(dtype=np.int64)
+        return keys
+    return np.array([int(str(d).ljust(14, fill)) for d in dates], dtype=np.int64)
+
+
+class NC4CatalogDataset():
+    """Lazy multi-file dataset of a catalog of files.
+
+    The ``startdate`` and ``enddate`` of the files in a selection are used
+    as a coarse time index, so that only the file holding a requested time
+    step is opened. In contrast to :class:`NC4MFDataset`, files are not
+    opened up front and may have any netCDF format including NETCDF4/HDF5.
+    Files are acquired from the :data:`pool` for each access, so that idle
+    files are closed if more than the maximum number of files are open.
+
+    Args:
+        selection (:class:`ESGF.ESGFFileSelection`): The files of one
+            dataset with ``startdate`` and ``enddate`` columns. Datetime
+            enddates have to be snapped to the end of their period, see
+            :meth:`ESGF.ESGFFileSelection.to_datetime`.
+        time_axis (str): The name of the time axis.
+
+    """
+
+    def __init__(self, selection, time_axis='time', **kwargs):
+        for column in ('variable', 'version'):
+            if column in selection.df and selection.df[column].nunique() > 1:
+                raise Exception('selection has more than one {}, use a subset'.format(column))
+        if hasattr(selection, 'dataset_ids') and len(np.unique(selection.dataset_ids)) > 1:
+            raise Exception('selection has more than one dataset, use a subset')
+        enddates = selection['enddate']
+        if pd.api.types.is_datetime64_any_dtype(enddates) and (enddates.dropna().dt.microsecond != 999999).any():
+            raise Exception('enddates are not snapped to the end of their period, '
+                            'use to_datetime(snap_end=True)')
+        self.time_axis = time_axis
+        self.kwargs    = kwargs
+        starts = filename_keys(selection['startdate'], '0')
+        ends   = filename_keys(enddates, '9')
+        order  = np.argsort(starts, kind='stable')
+        files  = selection.file_list
+        self.files  = [files[i] for i in order]
+        self.starts = starts[order]
+        self.ends   = ends[order]
+        if np.any(self.starts[1:] <= self.ends[:-1]):
+            raise Exception('the time ranges of the files overlap')
+        self._time_indexes = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def locate(self, dates):
+        """Returns the positions of the files holding the dates.
+        """
+        keys = date_keys(dates)
+        pos = np.searchsorted(self.starts, keys, side='right') - 1
+        if np.any(pos < 0) or np.any(keys > self.ends[np.maximum(pos, 0)]):
+            raise ValueError('some of the dates specified are not covered by the files')
+        return pos
+
+    @contextmanager
+    def dataset(self, pos):
+        """Context manager that acquires the :class:`NC4Dataset` of a file.
+
+        The handle is released on exit, the decoded time axis of the
+        file is kept for the next access.
+        """
+        with pool.handle(self.files[pos], **self.kwargs) as handle:
+            ds = NC4Dataset(ds=handle, time_axis=self.time_axis)
+            ds._time_index = self._time_indexes.get(pos)
+            yield ds
+            self._time_indexes[pos] = ds._time_index
+
+    def dataset_by_date(self, date):
+        """Context manager that acquires the :class:`NC4Dataset` of the file holding a date.
+        """
+        return self.dataset(int(self.locate(date)[0]))
+
+    def ncattrs_dict(self, varname=None):
+        with self.dataset(0) as ds:
+            return ds.ncattrs_dict(varname)
+
+    def get_timestep(self, date, varname):
+        with self.dataset_by_date(date) as ds:
+            return ds.get_timestep(date, varname)
+
+    def data_by_date(self, variable, date):
+        with self.dataset_by_date(date) as ds:
+            return ds.data_by_date(variable, date)
+
+    def get_timesteps(self, dates, varname):
+        """Returns the time steps of an array of dates.
+
+        The dates are grouped by file, each file is acquired once and
+        its time steps are read in one lookup.
+
+        Returns:
+            array: the time steps stacked in the order of the dates.
+
+        """
+        dates = np.atleast_1d(np.asarray(dates, dtype=object))
+        pos = self.locate(dates)
+        result = [None] * len(dates)
+        for p in np.unique(pos):
+            which = np.nonzero(pos == p)[0]
+            with self.dataset(int(p)) as ds:
+                indices = ds.get_index_by_dates(list(dates[which]))
+                data = ds.variables[varname][np.sort(indices)]
+            ranks = np.argsort(np.argsort(indices))
+            for i, rank in zip(which, ranks):
+                result[i] = data[rank]
+        return np.ma.stack(result)
+
+    def close(self):
+        """Drops the cached time axes, file handles are owned by the :data:`pool`.
+        """
+        self._time_indexes = {}
+
+
 class XRDataset():
 
     def __init__(self, file_list, time_axis='time'):
@@ -137,6 +532,14 @@ class XRMFDataset():
 
 
 def copy_dataset(src, varname=None, timestep=None, destination=None):
+    """Copies a dataset or a variable of it to a new file.
+
+    ``src`` may be an open dataset or a filename that is read
+    through the :data:`pool`.
+    """
+    if isinstance(src, str):
+        with pool.handle(src) as handle:
+            return copy_dataset(handle, varname, timestep, destination)
     if varname is None:
         variables = src.variables
     else:
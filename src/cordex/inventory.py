@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+"""inventory module
+
+This module compares the files expected from the CORDEX data request with
+the files that are present in an archive.
+
+A simulation is defined by its attributes (domain, models, experiment, ...)
+and a period of years. :func:`expected_files` expands it into the files of
+all variables and frequencies of the data request, split into time chunks
+according to the CORDEX archive specifications:
+
+    * ``1hr``, ``3hr``, ``6hr``: one file per year with 12 digit dates,
+      e.g., ``195101010000-195112312100`` for instantaneous and
+      ``195101010130-195112312230`` for time averaged 3 hourly variables.
+    * ``day``: five years per file, e.g., ``19510101-19551231``.
+    * ``mon``: ten years per file, e.g., ``195101-196012``.
+    * ``sem``: ten years per file from December, e.g., ``195012-196011``.
+
+Chunks are aligned to years ending with 1 or 6 and clipped to the period.
+Time invariant (``fx``) variables are not included since their filenames
+do not follow the CORDEX convention with dates.
+
+Example:
+
+    To find missing files of a simulation, you can use, e.g.,::
+
+        from cordex import ESGF, inventory
+
+        simulation = {'product': 'output', 'CORDEX_domain': 'EUR-11',
+                      'institute_id': 'GERICS', 'driving_model_id': 'MPI-M-MPI-ESM-LR',
+                      'experiment_id': 'historical', 'ensemble_member': 'r3i1p1',
+                      'model_id': 'GERICS-REMO2015', 'rcm_version_id': 'v1'}
+        selection = ESGF.get_selection('CORDEX', root=root, filter=simulation)
+        report = inventory.compare(simulation, (1950, 2005), selection)
+        report.missing
+
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+from . import variable as var
+from . import conventions as conv
+from . import ESGF
+
+
+__author__ = "Lars Buntemeyer"
+__copyright__ = "Lars Buntemeyer"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+# number of years per file of each frequency
+chunk_years = {'1hr': 1, '3hr': 1, '6hr': 1, 'day': 5, 'mon': 10, 'sem': 10}
+
+# month, day, hour and minute of the first and last date in the filename
+date_bounds = {'day': ('0101', '1231'), 'mon': ('01', '12'), 'sem': ('12', '11')}
+
+# sub-daily dates depend on the time cell method, time steps of
+# instantaneous ('i') variables start at 00:00, time steps of averaged
+# variables are the centers of the intervals
+subdaily_bounds = {'1hr': {'i': ('01010000', '12312300'), 'a': ('01010030', '12312330')},
+                   '3hr': {'i': ('01010000', '12312100'), 'a': ('01010130', '12312230')},
+                   '6hr': {'i': ('01010000', '12311800'), 'a': ('01010300', '12312100')}}
+
+
+Inventory = namedtuple('Inventory', ['expected', 'missing', 'unexpected'])
+Inventory.__doc__ = """Result of :func:`compare`.
+
+The ``expected`` and ``missing`` files are DataFrames of attributes with
+the ``path`` relative to the root. The ``unexpected`` files are the rows
+of the selection that are not expected.
+"""
+
+
+def time_chunks(frequency, start, end, cell_method='i'):
+    """Returns the dates of the files of a frequency for a period of years.
+
+    Args:
+        frequency (str): The frequency, e.g., ``'day'``.
+        start (int): The first year of the period.
+        end (int): The last year of the period.
+        cell_method (str): The time cell method of sub-daily variables,
+            ``'i'`` for instantaneous or ``'a'`` for time averaged.
+
+    Returns:
+        DataFrame: ``startdate`` and ``enddate`` of each file.
+
+    """
+    n = chunk_years[frequency]
+    years  = np.arange(start, end + 1)
+    blocks = np.unique((years - 1) // n)
+    first  = np.maximum(blocks * n + 1, start)
+    last   = np.minimum(blocks * n + n, end)
+    if frequency == 'sem':
+        first = first - 1
+    if frequency in subdaily_bounds:
+        start_suffix, end_suffix = subdaily_bounds[frequency][cell_method]
+    else:
+        start_suffix, end_suffix = date_bounds[frequency]
+    return pd.DataFrame({'frequency': frequency, 'cell_method': cell_method,
+                         'startdate': first.astype(str).astype(object) + start_suffix,
+                         'enddate': last.astype(str).astype(object) + end_suffix})
+
+
+def requested_variables(table='cmip5', variables=None, frequencies=None):
+    """Returns the variables and frequencies of the data request.
+
+    Args:
+        table (str): The data request table, see :func:`variable.table`.
+        variables (list): Restrict the variables.
+        frequencies (list): Restrict the frequencies.
+
+    Returns:
+        DataFrame: ``variable``, ``frequency`` and ``cell_method`` of
+        each requested output. The cell method is ``'i'`` for instantaneous
+        and ``'a'`` for all other variables.
+
+    """
+    request = var.table(table)
+    records = [(v, f.strip(), 'i' if method == 'i' else 'a') for v, freqs, method
+               in zip(request.index, request['frequency'], request['time_cell_method']) for f in freqs]
+    df = pd.DataFrame(records, columns=['variable', 'frequency', 'cell_method'])
+    df = df[df['frequency'].isin(list(chunk_years))]
+    if variables is not None:
+        df = df[df['variable'].isin(list(variables))]
+    if frequencies is not None:
+        df = df[df['frequency'].isin(list(frequencies))]
+    return df.drop_duplicates().reset_index(drop=True)
+
+
+def expected_files(simulation, period, convention_id='CORDEX', table='cmip5',
+                   variables=None, frequencies=None, version='*'):
+    """Expands a simulation into the files expected from the data request.
+
+    Args:
+        simulation (dict): The attributes of the simulation, e.g.,
+            ``CORDEX_domain``, ``driving_model_id``, ``experiment_id``, ...
+        period (tuple): The first and last year of the simulation.
+        convention_id (str): The ESGF convention of the filenames.
+        table (str): The data request table.
+        variables (list): Restrict the variables.
+        frequencies (list): Restrict the frequencies.
+        version (str): The version directory, if it is not given in
+            the simulation attributes.
+
+    Returns:
+        DataFrame: attributes and the ``path`` relative to the root of
+        each expected file.
+
+    """
+    request = requested_variables(table, variables, frequencies)
+    if len(request) == 0:
+        raise Exception('no variables requested for frequencies: {}'.format(frequencies))
+    chunks = pd.concat([time_chunks(f, period[0], period[1], m) for f, m
+                        in request[['frequency', 'cell_method']].drop_duplicates().itertuples(index=False)])
+    df = request.merge(chunks, on=['frequency', 'cell_method'])
+    attrs = dict({'version': version, 'suffix': 'nc'}, **simulation)
+    for key, value in attrs.items():
+        df[key] = value
+    convention = ESGF.get_convention(convention_id)
+    df['path'] = convention.format_frame(df)
+    return df
+
+
+def compare(simulation, period, selection, **kwargs):
+    """Compares the expected files of a simulation with a selection.
+
+    Files are compared by their path relative to the root. If the
+    version is not given in the simulation attributes, the version
+    directory is ignored.
+
+    Args:
+        simulation (dict): The attributes of the simulation.
+        period (tuple): The first and last year of the simulation.
+        selection (:class:`conventions.FileSelection`): The files present,
+            e.g., from :func:`ESGF.get_selection` or a catalog.
+        **kwargs: Passed to :func:`expected_files`.
+
+    Returns:
+        :class:`Inventory` of expected, missing and unexpected files.
+
+    """
+    expected = expected_files(simulation, period, **kwargs)
+    present  = selection.df['path'].astype(str)
+    expected_keys = expected['path']
+    if 'version' not in simulation and kwargs.get('version', '*') == '*':
+        convention = ESGF.get_convention(kwargs.get('convention_id', 'CORDEX'))
+        level = convention.path_conv.conv_list.index('version')
+        present = _drop_level(present, level)
+        expected_keys = _drop_level(expected_keys, level)
+    positions, found = conv.join_columns(expected_keys, present)
+    known = positions >= 0
+    missing = expected[~found].reset_index(drop=True)
+    unexpected = selection.df[~known]
+    _logger.info('{} files expected, {} missing, {} unexpected'.format(len(expected), len(missing),
+                                                                     len(unexpected)))
+    return Inventory(expected, missing, unexpected)
+
+
+def _drop_level(paths, level):
+    """Removes one directory level from relative pathes.
+    """
+    return paths.str.replace(r'^((?:[^/]*/){{{}}})[^/]*/'.format(level), r'\1', regex=True)
+
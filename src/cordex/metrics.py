@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+"""metrics module
+
+This module defines instruments that are notified by crawl and parse
+operations, e.g., :func:`conventions.crawl`, :func:`conventions.make_df`
+and :meth:`catalog.FileCatalog.refresh`.
+
+An instrument receives the following events:
+
+    * ``listed``: a directory was listed, with its level and latency.
+    * ``failed``: a directory could not be listed, with the error.
+    * ``matched``: files were found by a crawler.
+    * ``rejected``: files did not conform to the convention.
+    * ``statted``: a file was statted, with its size in bytes.
+    * ``parsed``: a list of files was parsed, with its duration.
+    * ``hashed``: a file was hashed, with its size and duration.
+
+The default :class:`Instrument` ignores all events. A :class:`Metrics`
+instrument collects them and summarizes directories scanned, files matched
+and rejected, bytes statted, latencies per directory level and throughput.
+The summary can be exported to logging (:class:`LoggingMetrics`) or to
+a metrics callback (:class:`CallbackMetrics`).
+
+Example:
+
+    To find slow storage targets during a crawl, you can use, e.g.,::
+
+        from cordex import ESGF
+        from cordex.metrics import LoggingMetrics
+
+        metrics = LoggingMetrics(slow=1.0)
+        selection = ESGF.get_selection('CORDEX', filter={'variable': 'tas'},
+                                       instrument=metrics)
+        metrics.report()
+
+"""
+
+import time
+import logging
+import threading
+from collections import defaultdict
+
+
+__author__ = "Lars Buntemeyer"
+__copyright__ = "Lars Buntemeyer"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+class Instrument(object):
+    """Instrument that ignores all events.
+
+    This is the default instrument with negligible overhead. Subclasses
+    override the events they are interested in.
+    """
+
+    def listed(self, path, level, entries, seconds):
+        pass
+
+    def failed(self, path, error):
+        pass
+
+    def matched(self, count):
+        pass
+
+    def rejected(self, count):
+        pass
+
+    def statted(self, size):
+        pass
+
+    def parsed(self, count, seconds):
+        pass
+
+    def hashed(self, size, seconds):
+        pass
+
+
+NULL = Instrument()
+
+
+def get_instrument(instrument=None):
+    """Returns the instrument or the default instrument if ``None``.
+    """
+    if instrument is None:
+        return NULL
+    return instrument
+
+
+class _Latency(object):
+    """Accumulates the latencies of one directory level.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max   = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max    = max(self.max, seconds)
+
+    def to_dict(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {'count': self.count, 'mean': mean, 'max': self.max, 'total': self.total}
+
+
+class Metrics(Instrument):
+    """Instrument that collects crawl and parse metrics.
+
+    Events may be reported from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Resets all counters and the start time.
+        """
+        self.start     = time.perf_counter()
+        self.dirs      = 0
+        self.entries   = 0
+        self.failures  = 0
+        self.files     = 0
+        self.rejects   = 0
+        self.bytes     = 0
+        self.parsing   = 0.0
+        self.hashes    = 0
+        self.hashed_bytes = 0
+        self.hashing   = 0.0
+        self.latencies = defaultdict(_Latency)
+
+    def listed(self, path, level, entries, seconds):
+        with self._lock:
+            self.dirs    += 1
+            self.entries += entries
+            self.latencies[level].add(seconds)
+
+    def failed(self, path, error):
+        with self._lock:
+            self.failures += 1
+
+    def matched(self, count):
+        with self._lock:
+            self.files += count
+
+    def rejected(self, count):
+        with self._lock:
+            self.rejects += count
+
+    def statted(self, size):
+        with self._lock:
+            self.bytes += size
+
+    def parsed(self, count, seconds):
+        with self._lock:
+            self.parsing += seconds
+
+    def hashed(self, size, seconds):
+        with self._lock:
+            self.hashes       += 1
+            self.hashed_bytes += size
+            self.hashing      += seconds
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def summary(self):
+        """Summarizes the collected metrics.
+
+        Returns:
+            dict: counters, latencies per directory level and throughput
+            in directories and files per second.
+
+        """
+        elapsed = self.elapsed
+        with self._lock:
+            return {'directories': self.dirs,
+                    'entries': self.entries,
+                    'failed': self.failures,
+                    'files': self.files,
+                    'rejected': self.rejects,
+                    'bytes': self.bytes,
+                    'parse_seconds': self.parsing,
+                    'hashed_files': self.hashes,
+                    'hashed_bytes': self.hashed_bytes,
+                    'hash_seconds': self.hashing,
+                    'elapsed': elapsed,
+                    'directories_per_second': self.dirs / elapsed if elapsed else 0.0,
+                    'files_per_second': self.files / elapsed if elapsed else 0.0,
+                    'latency': {level: latency.to_dict() for level, latency
+                                in sorted(self.latencies.items())}}
+
+    def report(self, logger=None, level=logging.INFO):
+        """Logs the summary of the collected metrics.
+        """
+        logger = logger or _logger
+        summary = self.summary()
+        if summary['hashed_files']:
+            logger.log(level, 'hashed {hashed_files} files with {hashed_bytes} bytes '
+                       'in {hash_seconds:.3f}s of thread time'.format(**summary))
+        logger.log(level, 'scanned {directories} directories, matched {files} files, '
+                   'rejected {rejected}, statted {bytes} bytes in {elapsed:.3f}s '
+                   '({directories_per_second:.1f} dirs/s, {files_per_second:.1f} files/s)'.format(**summary))
+        if summary['failed']:
+            logger.log(level, '{failed} directories could not be listed'.format(**summary))
+        for lev, latency in summary['latency'].items():
+            logger.log(level, 'level {}: {count} listings, mean latency {mean:.4f}s, '
+                       'max {max:.4f}s'.format(lev, **latency))
+        return summary
+
+
+class LoggingMetrics(Metrics):
+    """Collects metrics and logs slow directory listings.
+
+    Args:
+        slow (float): Listings taking longer than ``slow`` seconds
+            are logged as warnings.
+        logger (:class:`logging.Logger`): The logger to use.
+
+    """
+
+    def __init__(self, slow=1.0, logger=None):
+        Metrics.__init__(self)
+        self.slow   = slow
+        self.logger = logger or _logger
+
+    def listed(self, path, level, entries, seconds):
+        Metrics.listed(self, path, level, entries, seconds)
+        if seconds > self.slow:
+            self.logger.warning('slow listing of {} ({} entries): {:.3f}s'.format(path, entries, seconds))
+        else:
+            self.logger.debug('listed {} ({} entries): {:.4f}s'.format(path, entries, seconds))
+
+    def failed(self, path, error):
+        Metrics.failed(self, path, error)
+        self.logger.warning('could not list {}: {}'.format(path, error))
+
+    def report(self, logger=None, level=logging.INFO):
+        return Metrics.report(self, logger or self.logger, level)
+
+
+class CallbackMetrics(Metrics):
+    """Collects metrics and passes each event to a callback.
+
+    The callback is called with the name of the metric, its value and
+    a dictionary of tags, e.g., ``callback('listing_seconds', 0.02, {'level': 3})``.
+    This allows to export metrics to a monitoring system.
+
+    Args:
+        callback (callable): The metrics callback.
+
+    """
+
+    def __init__(self, callback):
+        Metrics.__init__(self)
+        self.callback = callback
+
+    def listed(self, path, level, entries, seconds):
+        Metrics.listed(self, path, level, entries, seconds)
+        self.callback('listing_seconds', seconds, {'level': level, 'path': path, 'entries': entries})
+
+    def failed(self, path, error):
+        Metrics.failed(self, path, error)
+        self.callback('listing_failed', 1, {'path': path, 'error': str(error)})
+
+    def matched(self, count):
+        Metrics.matched(self, count)
+        self.callback('files_matched', count, {})
+
+    def rejected(self, count):
+        Metrics.rejected(self, count)
+        self.callback('files_rejected', count, {})
+
+    def statted(self, size):
+        Metrics.statted(self, size)
+        self.callback('bytes_statted', size, {})
+
+    def parsed(self, count, seconds):
+        Metrics.parsed(self, count, seconds)
+        self.callback('parse_seconds', seconds, {'files': count})
+
+    def hashed(self, size, seconds):
+        Metrics.hashed(self, size, seconds)
+        self.callback('hash_seconds', seconds, {'bytes': size})
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+"""search module
+
+This module defines a client for the search API of an ESGF index node.
+
+The :class:`SearchClient` maps filters of a :class:`conventions.FileSelection`
+onto the facets of the search API, pages through the results with
+concurrent requests over a pool of HTTP connections and returns an
+:class:`ESGF.ESGFFileSelection` with the same attributes as a selection
+of files on disk. Responses can be cached on disk.
+
+Example:
+
+    To search for files on an index node, you can use, e.g.,::
+
+        from cordex.search import SearchClient
+
+        client = SearchClient('https://esgf-data.dkrz.de/esg-search/search',
+                              cache='~/.cache/cordex')
+        selection = client.search({'CORDEX_domain': 'EUR-11', 'variable': ['tas', 'pr'],
+                                   'frequency': 'day'})
+        selection.df['url']
+
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import urllib3
+import pandas as pd
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from . import conventions as conv
+from . import ESGF
+
+
+__author__ = "Lars Buntemeyer"
+__copyright__ = "Lars Buntemeyer"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+# attribute names of the conventions mapped to facets of the search API
+FACETS = {'CORDEX': {'product': 'product', 'CORDEX_domain': 'domain',
+                     'institute_id': 'institute', 'driving_model_id': 'driving_model',
+                     'experiment_id': 'experiment', 'ensemble_member': 'ensemble',
+                     'model_id': 'rcm_name', 'rcm_version_id': 'rcm_version',
+                     'frequency': 'time_frequency', 'variable': 'variable',
+                     'version': 'version'},
+          'CMIP5':  {'product': 'product', 'institute': 'institute', 'model': 'model',
+                     'experiment': 'experiment', 'frequency': 'time_frequency',
+                     'modeling_realm': 'realm', 'mip_table': 'cmor_table',
+                     'ensemble_member': 'ensemble', 'variable': 'variable',
+                     'version': 'version'}}
+
+# attributes whose facet values and dataset id levels omit the value of
+# another attribute as prefix, e.g., model_id 'GERICS-REMO2015' is
+# searched as rcm_name 'REMO2015' of institute 'GERICS'
+PREFIXED = {'CORDEX': {'model_id': 'institute_id'}}
+
+# fields of the file records returned by the search API
+FIELDS = ['id', 'dataset_id', 'title', 'variable', 'size', 'checksum', 'checksum_type', 'url']
+
+
+class SearchClient(object):
+    """Client for the file search of an ESGF index node.
+
+    Args:
+        url (str): The search endpoint, e.g.,
+            ``'https://esgf-data.dkrz.de/esg-search/search'``.
+        convention_id (str): The ESGF convention of the project.
+        cache (str): Directory for cached responses. If ``None``,
+            responses are not cached.
+        ttl (float): Time in seconds cached responses are valid.
+        page_size (int): Number of records requested per page.
+        concurrency (int): Maximum number of pages requested at once.
+        timeout (float): Timeout of each request in seconds.
+        retries (int): Number of retries of a failed request.
+
+    """
+
+    def __init__(self, url, convention_id='CORDEX', cache=None, ttl=3600, page_size=500,
+                 concurrency=8, timeout=60, retries=3):
+        self.url           = url
+        self.convention_id = convention_id
+        self.convention    = ESGF.get_convention(convention_id)
+        self.facets        = FACETS.get(convention_id, {})
+        self.prefixed      = PREFIXED.get(convention_id, {})
+        self.cache         = os.path.expanduser(cache) if cache else None
+        self.ttl           = ttl
+        self.page_size     = page_size
+        self.concurrency   = concurrency
+        self.http          = urllib3.PoolManager(maxsize=concurrency, timeout=timeout,
+                                                 retries=urllib3.Retry(retries, backoff_factor=0.5))
+        if self.cache:
+            os.makedirs(self.cache, exist_ok=True)
+
+    def params(self, filter={}):
+        """Maps filter attributes onto search API parameters.
+
+        Single values and lists of values are passed to the search API,
+        negations starting with ``!`` become ``facet!=value``. Wildcards
+        and ranges can not be searched and are returned as residual filter.
+        Attributes in ``PREFIXED`` are searched without the prefix if it
+        is given in the filter and are a residual filter otherwise. Versions
+        are searched without the leading ``v`` of the directory name.
+
+        Returns:
+            tuple: list of query parameters and the residual filter.
+
+        """
+        params = [('project', self.convention_id), ('type', 'File'),
+                  ('format', 'application/solr+json'), ('fields', ','.join(FIELDS))]
+        residual = {}
+        for key, value in filter.items():
+            facet = self.facets.get(key, key)
+            if isinstance(value, slice) or (isinstance(value, str) and conv.glob.has_magic(value)):
+                residual[key] = value
+            elif key in self.prefixed:
+                prefix = filter.get(self.prefixed[key])
+                if not isinstance(prefix, str) or conv.glob.has_magic(prefix) or prefix.startswith('!'):
+                    residual[key] = value
+                elif isinstance(value, str) and value.startswith('!'):
+                    params.append((facet + '!', _strip_prefix(value[1:], prefix)))
+                else:
+                    params.extend((facet, _strip_prefix(v, prefix)) for v in conv.values(value))
+            elif isinstance(value, str) and value.startswith('!'):
+                params.append((facet + '!', _facet_value(key, value[1:])))
+            else:
+                params.extend((facet, _facet_value(key, v)) for v in conv.values(value))
+        return params, residual
+
+    def _cache_file(self, url):
+        return os.path.join(self.cache, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def request(self, params):
+        """Requests one page of the search API, using the cache if possible.
+
+        Returns:
+            dict: the decoded JSON response.
+
+        """
+        url = self.url + '?' + urlencode(params).replace('%21=', '!=')
+        if self.cache:
+            filename = self._cache_file(url)
+            if os.path.isfile(filename) and time.time() - os.stat(filename).st_mtime < self.ttl:
+                with open(filename) as f:
+                    return json.load(f)
+        _logger.debug('requesting {}'.format(url))
+        response = self.http.request('GET', url)
+        if response.status != 200:
+            raise Exception('search request failed with status {}: {}'.format(response.status, url))
+        data = json.loads(response.data)
+        if self.cache:
+            # write atomically, other clients may read the cache at the same time
+            tmp = filename + '.{}.tmp'.format(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, filename)
+        return data
+
+    def records(self, filter={}, limit=None):
+        """Returns the file records of a search.
+
+        The first page is requested to find the number of results, the
+        remaining pages are requested concurrently.
+
+        Args:
+            filter (dict): Defines attributes to filter the search.
+            limit (int): Maximum number of records.
+
+        Returns:
+            list: the records as dictionaries.
+
+        """
+        params, residual = self.params(filter)
+        page_size = min(self.page_size, limit) if limit else self.page_size
+        first = self.request(params + [('offset', 0), ('limit', page_size)])['response']
+        total = first['numFound'] if limit is None else min(first['numFound'], limit)
+        offsets = range(page_size, total, page_size)
+        _logger.info('found {} files, requesting {} pages'.format(total, len(offsets) + 1))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pages = executor.map(lambda offset: self.request(params + [('offset', offset),
+                                 ('limit', min(page_size, total - offset))])['response']['docs'], offsets)
+            docs = list(first['docs'])
+            for page in pages:
+                docs.extend(page)
+        return docs[:total]
+
+    def search(self, filter={}, limit=None):
+        """Searches files and returns them as a selection.
+
+        The relative path of each file is derived from its dataset id,
+        so that the attributes are parsed by the convention like for files
+        on disk. The selection has the additional columns ``size``,
+        ``checksum``, ``checksum_type`` and the HTTP ``url`` of each file.
+
+        Args:
+            filter (dict): Defines attributes to filter the search, see
+                :meth:`conventions.FileSelection.subset` for the values.
+            limit (int): Maximum number of files.
+
+        Returns:
+            :class:`ESGF.ESGFFileSelection` object.
+
+        """
+        docs = self.records(filter, limit)
+        if not docs:
+            raise Exception('no files found for filter: {}'.format(filter))
+        levels = self.convention.path_conv.conv_list
+        df = pd.DataFrame({'path': [_relative_path(doc, levels, self.prefixed) for doc in docs],
+                           'size': [doc.get('size') for doc in docs],
+                           'checksum': [_first(doc.get('checksum')) for doc in docs],
+                           'checksum_type': [_first(doc.get('checksum_type')) for doc in docs],
+                           'url': [_http_url(doc.get('url', [])) for doc in docs]})
+        df = df.drop_duplicates('path').reset_index(drop=True)
+        df, rejected = conv.make_table(self.convention, df)
+        selection = ESGF.ESGFFileSelection(df, rejected=rejected)
+        params, residual = self.params(filter)
+        if residual:
+            selection = selection.subset(**residual)
+        return selection
+
+
+def _first(value):
+    """Returns the first value of a multi-valued field.
+    """
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def _facet_value(key, value):
+    """Returns the value of an attribute as it is searched.
+    """
+    if key == 'version' and value.startswith('v'):
+        return value[1:]
+    return value
+
+
+def _strip_prefix(value, prefix):
+    """Removes the value of another attribute from the start of a value.
+    """
+    if value.startswith(prefix + '-'):
+        return value[len(prefix) + 1:]
+    return value
+
+
+def _relative_path(doc, conv_list, prefixed={}):
+    """Creates the path of a file relative to the root from its dataset id.
+
+    The dataset id, e.g., ``cordex.output.EUR-11.<...>.v20190925|data.node``
+    holds the directory levels after the project. If the last level is
+    missing, like for CMIP5, it is the variable. Levels in ``prefixed``
+    get the prefix of the directory names, e.g., ``REMO2015`` becomes
+    ``GERICS-REMO2015``.
+    """
+    levels = doc['dataset_id'].split('|')[0].split('.')[1:]
+    if len(levels) == len(conv_list) - 1:
+        levels.append(_first(doc['variable']))
+    for key, prefix_key in prefixed.items():
+        i, j = conv_list.index(key), conv_list.index(prefix_key)
+        if not levels[i].startswith(levels[j] + '-'):
+            levels[i] = levels[j] + '-' + levels[i]
+    return os.path.join(*levels, _first(doc['title']))
+
+
+def _http_url(urls):
+    """Returns the HTTPServer url of a file.
+    """
+    for url in urls:
+        parts = url.split('|')
+        if len(parts) == 3 and parts[2] == 'HTTPServer':
+            return parts[0]
+    return None
@@ -7,4 +7,31 @@
     https://pytest.org/latest/plugins.html
 """
 
-# import pytest
+import os
+import pytest
+
+cordex_path     = 'output/EUR-11/GERICS/MPI-M-MPI-ESM-LR/historical/r3i1p1/GERICS-REMO2015/v1/day/{variable}/{version}'
+cordex_filename = '{variable}_EUR-11_MPI-M-MPI-ESM-LR_historical_r3i1p1_GERICS-REMO2015_v1_day_{year}0101-{year}1231.nc'
+
+
+@pytest.fixture
+def cordex_files():
+    """Returns a factory that creates yearly CORDEX files below a root directory.
+
+    The factory takes the root, the variables, the years and the version
+    and returns the created filenames. Files are empty unless a ``writer``
+    is given that is called with the filename and the year.
+    """
+    def create(root, variables=('tas', 'pr'), years=range(1950, 1960), version='v20190925', writer=None):
+        files = []
+        for variable in variables:
+            path = os.path.join(str(root), cordex_path.format(variable=variable, version=version))
+            os.makedirs(path, exist_ok=True)
+            for year in years:
+                files.append(os.path.join(path, cordex_filename.format(variable=variable, year=year)))
+                if writer is None:
+                    open(files[-1], 'w').close()
+                else:
+                    writer(files[-1], year)
+        return files
+    return create
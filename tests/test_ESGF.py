@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 # flake8: noqa
 import os
+import datetime as dt
 import pytest
+import pandas as pd
 from cordex import ESGF
+from cordex import metrics
 
 __author__ = "Lars Buntemeyer"
 __copyright__ = "Lars Buntemeyer"
@@ -40,8 +43,274 @@ def test_cmip5():
     # test if filename is reconstructed correctly
     assert cordex.pattern(**attrs) == filename
 
+def test_cmip5_parse_list():
+    cmip5 = ESGF.get_convention('CMIP5', root=cmip5_root)
+    fx_file = os.path.join(cmip5_root, 'output1/MPI-M/MPI-ESM-LR/historical/fx/atmos/fx/r0i0p0/v20111006/orog',
+                           'orog_fx_MPI-ESM-LR_historical_r0i0p0.nc')
+    files = [os.path.join(cmip5_root, cmip5_path, cmip5_filename), fx_file, os.path.join(cmip5_root, 'bad.nc')]
+    df, rejected = cmip5.parse_list(files)
+    assert list(df['path']) == files[:2]
+    assert list(df['variable']) == ['vas', 'orog']
+    assert df['startdate'].iloc[0] == '19500101'
+    assert list(rejected) == files[2:]
+
+
+def test_get_selection_workers(tmp_path, cordex_files):
+    files = cordex_files(str(tmp_path))
+    serial   = ESGF.get_selection('CORDEX', root=str(tmp_path))
+    parallel = ESGF.get_selection('CORDEX', root=str(tmp_path), workers=2)
+    assert sorted(serial.file_list) == sorted(files)
+    assert serial.df.sort_values('path').reset_index(drop=True).equals(
+           parallel.df.sort_values('path').reset_index(drop=True))
+
+
+def test_get_selection_stat(tmp_path, cordex_files):
+    files = cordex_files(str(tmp_path), variables=['tas'], years=[1950])
+    leaf = os.path.dirname(files[0])
+    open(os.path.join(leaf, '.hidden.nc'), 'w').close()
+    os.makedirs(os.path.join(leaf, 'subdir'))
+    with open(files[0], 'w') as f:
+        f.write('data')
+    selection = ESGF.get_selection('CORDEX', root=str(tmp_path), filter={'variable': 'tas'}, stat=True)
+    assert selection.file_list == files
+    assert list(selection['size']) == [4]
+    assert selection['mtime'].iloc[0] == os.stat(files[0]).st_mtime
+
+
+def test_get_selection_metrics(tmp_path, cordex_files):
+    files = cordex_files(str(tmp_path), years=[1950, 1951])
+    with open(files[0], 'w') as f:
+        f.write('data')
+    events = []
+    instrument = metrics.CallbackMetrics(lambda name, value, tags: events.append(name))
+    selection = ESGF.get_selection('CORDEX', root=str(tmp_path), stat=True, instrument=instrument)
+    assert len(selection.df) == 4
+    summary = instrument.summary()
+    assert summary['files'] == 4
+    assert summary['rejected'] == 0
+    assert summary['bytes'] == 4
+    assert summary['directories'] == sum(l['count'] for l in summary['latency'].values())
+    assert summary['latency'][10]['count'] == 2
+    assert {'listing_seconds', 'files_matched', 'files_rejected', 'bytes_statted', 'parse_seconds'} <= set(events)
+    # files that do not conform to the convention are rejected
+    convention = ESGF.get_convention('CORDEX', root=str(tmp_path))
+    instrument.reset()
+    ESGF.conv.make_df(convention, files + [os.path.join(str(tmp_path), 'tas.nc')], instrument=instrument)
+    assert instrument.summary()['rejected'] == 1
+
+
+def test_selection_parquet(tmp_path, cordex_files):
+    files = cordex_files(str(tmp_path / 'data'))
+    selection = ESGF.get_selection('CORDEX', root=str(tmp_path / 'data'), stat=True).to_datetime()
+    for ext in ['parquet', 'feather']:
+        filename = str(tmp_path / 'selection.{}'.format(ext))
+        getattr(selection, 'to_{}'.format(ext))(filename)
+        reader = getattr(ESGF, 'file_selection_from_{}'.format(ext))
+        loaded = reader(filename)
+        assert loaded.root == selection.root
+        assert sorted(loaded.file_list) == sorted(files)
+        assert isinstance(loaded['variable'].dtype, pd.CategoricalDtype)
+        assert pd.api.types.is_datetime64_any_dtype(loaded['startdate'])
+        subset = reader(filename, columns=['path', 'startdate'],
+                        filter={'variable': 'pr', 'startdate': slice(dt.datetime(1955, 1, 1), None)})
+        assert list(subset.df.columns) == ['path', 'startdate']
+        assert len(subset.df) == 5
+        assert len(reader(filename, filter={'variable': '!pr', 'experiment_id': 'hist*'}).df) == 10
+    selection.to_csv(str(tmp_path / 'selection.csv'))
+    loaded = ESGF.file_selection_from_csv(str(tmp_path / 'selection.csv'))
+    assert list(loaded['size']) == list(selection['size'])
+
+
+def test_detect_convention(tmp_path, cordex_files):
+    cordex_root = str(tmp_path / 'cordex')
+    cordex_files(cordex_root, variables=['tas', 'pr', 'ps'])
+    open(os.path.join(cordex_root, 'README'), 'w').close()
+    detection = ESGF.detect_convention(cordex_root, seed=0)
+    assert detection.convention.name == 'CORDEX'
+    assert detection.convention.root == cordex_root
+    assert detection.confidence > 0.5
+    assert detection.scores['ERA5'] == 0.0
+    era5_root = str(tmp_path / 'era5')
+    for year in range(1979, 1989):
+        os.makedirs(os.path.join(era5_root, 'ml00_1H', str(year)))
+        for day in range(1, 20):
+            open(os.path.join(era5_root, 'ml00_1H', str(year),
+                              'E5ml00_1H_{}-01-{:02d}_129'.format(year, day)), 'w').close()
+    detection = ESGF.detect_convention(era5_root, seed=0)
+    assert detection.convention.name == 'ERA5'
+    assert detection.confidence == 1.0
+    assert ESGF.detect_convention(str(tmp_path / 'empty')).convention is None
+
+
+def test_parse_errors(tmp_path, cordex_files):
+    root = str(tmp_path)
+    files = cordex_files(root, variables=['tas'], years=[1950])
+    convention = ESGF.get_convention('CORDEX', root=root)
+    bad = ['/elsewhere/' + cordex_filename, os.path.join(root, 'output', cordex_filename),
+           os.path.join(os.path.dirname(files[0]), 'tas.nc')]
+    df, rejected = ESGF.conv.make_table(convention, files + bad)
+    assert len(df) == 1
+    assert list(rejected['path']) == bad
+    assert list(rejected['level']) == ['root', 'path', 'filename']
+    df, rejected = ESGF.conv.make_table(convention, files + bad, errors='skip')
+    assert len(rejected) == 0
+    with pytest.raises(ESGF.conv.ParseError) as error:
+        ESGF.conv.make_table(convention, files + bad, errors='raise')
+    assert error.value.level == 'root'
+    with pytest.raises(ESGF.conv.ParseError):
+        convention.parse(bad[2])
+    # typed fields reject files while crawling
+    era5 = ESGF.DKRZ.ERA5(root=str(tmp_path / 'era5'))
+    os.makedirs(str(tmp_path / 'era5' / 'ml00_1H' / '1979'))
+    for name in ['E5ml00_1H_1979-01-01_129', 'E5mlxx_1H_1979-01-01_129']:
+        open(str(tmp_path / 'era5' / 'ml00_1H' / '1979' / name), 'w').close()
+    selection = ESGF.conv.get_selection(era5)
+    assert len(selection.df) == 1
+    assert selection.rejected['path'].iloc[0].endswith('E5mlxx_1H_1979-01-01_129')
+    # derived selections keep the rejected files
+    assert selection.subset(code='129').rejected is selection.rejected
+    df, rejected = ESGF.conv.make_table(convention, files + bad)
+    cordex = ESGF.ESGFFileSelection(df, root=root, rejected=rejected)
+    assert len(cordex.subset(variable='tas').to_datetime().select_timerange(
+               (dt.datetime(1950, 1, 1), dt.datetime(1951, 1, 1))).latest().rejected) == 3
+    with pytest.raises(ESGF.conv.ParseError):
+        ESGF.conv.get_selection(era5, errors='raise')
+
+
+def test_checksums(tmp_path, cordex_files):
+    files = cordex_files(str(tmp_path), variables=['tas'], years=range(1950, 1955))
+    for f in files:
+        with open(f, 'w') as fh:
+            fh.write(os.path.basename(f) * 1000)
+    selection = ESGF.get_selection('CORDEX', root=str(tmp_path), stat=True)
+    instrument = metrics.Metrics()
+    hashed = selection.checksums(workers=4, instrument=instrument)
+    assert instrument.summary()['hashed_files'] == 5
+    expected = ESGF.conv.file_checksum(hashed.file_list[0])
+    assert hashed['checksum'].iloc[0] == expected
+    assert len(expected) == 64
+    # unchanged files are not hashed again
+    with open(files[2], 'a') as fh:
+        fh.write('changed')
+    instrument.reset()
+    rehashed = hashed.checksums(instrument=instrument)
+    assert instrument.summary()['hashed_files'] == 1
+    assert rehashed['checksum'].iloc[0] == expected
+    assert len(rehashed.verify()) == 0
+    assert list(hashed.verify()['path']) == [os.path.relpath(files[2], str(tmp_path))]
+
+
+def test_selection_categorical(tmp_path, cordex_files):
+    files = cordex_files(str(tmp_path))
+    selection = ESGF.get_selection('CORDEX', root=str(tmp_path))
+    assert selection['variable'].dtype == 'category'
+    assert not selection['path'].iloc[0].startswith(str(tmp_path))
+    tas = selection.subset(variable='tas', startdate='19550101')
+    assert tas.file_list == [f for f in files if os.path.basename(f).startswith('tas_') and '1955' in f]
+    assert list(tas.subset(variable='pr').df.index) == []
+    assert list(ESGF.conv.unique_values(tas['variable'])) == ['tas']
+    assert tas.unique
+    assert not selection.unique
+
+
+def test_to_datetime():
+    df = pd.DataFrame({'startdate': ['19510101', '195001', '200601010000', None],
+                       'enddate'  : ['19551231', '195012', '200612312100', None]})
+    selection = ESGF.ESGFFileSelection(df).to_datetime(snap_end=True)
+    assert df['startdate'].iloc[0] == '19510101'
+    assert list(selection.df.index) == [1, 0, 2, 3]
+    assert selection['startdate'].iloc[0] == dt.datetime(1950, 1, 1)
+    assert selection['enddate'].iloc[0] == pd.Timestamp(1950, 12, 31, 23, 59, 59, 999999)
+    assert selection['enddate'].iloc[2] == pd.Timestamp(2006, 12, 31, 21, 0, 59, 999999)
+    assert pd.isna(selection['startdate'].iloc[3])
+    dates = ESGF.to_datetime(pd.Series(['19500101', '1950']).astype('category'))
+    assert list(dates) == [dt.datetime(1950, 1, 1)] * 2
+
+
+def test_select_timerange():
+    df = pd.DataFrame({'variable' : ['tas', 'tas', 'tas', 'pr', 'pr', 'orog'],
+                       'startdate': ['19510101', '19560101', '19610101', '195101', '196101', None],
+                       'enddate'  : ['19551231', '19601231', '19651231', '196012', '197012', None]})
+    selection = ESGF.ESGFFileSelection(df)
+    # the pr file from 1951 to 1960 spans the whole range
+    subset = selection.select_timerange((dt.datetime(1956, 6, 1), dt.datetime(1957, 1, 1)))
+    assert sorted(subset.df.index) == [1, 3]
+    subset = selection.select_timerange((dt.datetime(1955, 12, 31, 12), dt.datetime(1961, 1, 1)))
+    assert sorted(subset.df.index) == [0, 1, 2, 3, 4]
+    assert len(selection.select_timerange((dt.datetime(1900, 1, 1), dt.datetime(1950, 1, 1))).df) == 0
+
+
+def test_dates_beyond_2262():
+    df = pd.DataFrame({'variable' : ['tas', 'tas', 'tas'], 'frequency': ['day'] * 3,
+                       'startdate': ['00010101', '22560101', '22810101'],
+                       'enddate'  : ['00011231', '22801231', '23001231'],
+                       'path'     : ['tas0', 'tas1', 'tas2']})
+    selection = ESGF.ESGFFileSelection(df).to_datetime(snap_end=True)
+    assert selection['enddate'].iloc[2] == pd.Timestamp(2300, 12, 31, 23, 59, 59, 999999)
+    assert selection['startdate'].iloc[0] == dt.datetime(1, 1, 1)
+    subset = selection.select_timerange((dt.datetime(2290, 1, 1), dt.datetime(2290, 2, 1)))
+    assert list(subset['path']) == ['tas2']
+    assert list(ESGF.ESGFFileSelection(df).coverage()['path']) == ['tas1']
+
+
+def test_coverage():
+    df = pd.DataFrame({'variable' : ['tas', 'tas', 'tas', 'pr', 'pr', 'pr', 'orog'],
+                       'frequency': ['day', 'day', 'day', 'mon', 'mon', 'mon', 'fx'],
+                       'startdate': ['19560101', '19510101', '19620101', '195101', '196101', '196501', None],
+                       'enddate'  : ['19601231', '19551231', '19651231', '196012', '197012', '197512', None],
+                       'path'     : ['tas2', 'tas1', 'tas3', 'pr1', 'pr2', 'pr3', 'orog']})
+    issues = ESGF.ESGFFileSelection(df).coverage().sort_values('path')
+    assert list(issues['issue']) == ['overlap', 'gap']
+    assert list(issues['path']) == ['pr3', 'tas3']
+    assert issues['expected'].iloc[1] == dt.datetime(1961, 1, 1)
+    assert issues['startdate'].iloc[1] == dt.datetime(1962, 1, 1)
+    # snapped enddates give the same result
+    snapped = ESGF.ESGFFileSelection(df).to_datetime(snap_end=True).coverage()
+    assert sorted(snapped['path']) == ['pr3', 'tas3']
+
+
+def test_datasets(tmp_path, cordex_files):
+    cordex_files(str(tmp_path), variables=['tas', 'pr', 'orog'], years=[1950, 1951])
+    selection = ESGF.get_selection('CORDEX', root=str(tmp_path))
+    assert selection.nunique['variable'] == 3
+    assert not selection.unique
+    datasets = selection.datasets()
+    assert len(datasets) == 3
+    for key, dataset in datasets.items():
+        assert dataset.unique
+        assert len(dataset.df) == 2
+        assert key[selection.dataset_columns.index('variable')] == dataset['variable'].iloc[0]
+        assert dataset.root == str(tmp_path)
+
+
+def test_latest(tmp_path, cordex_files):
+    old = cordex_files(str(tmp_path), variables=['tas', 'pr'], years=[1950])
+    new = cordex_files(str(tmp_path), variables=['pr'], years=[1950], version='v20200101')
+    selection = ESGF.get_selection('CORDEX', root=str(tmp_path))
+    assert len(selection.df) == 3
+    assert sorted(selection.latest().file_list) == sorted([old[0]] + new)
+    pruned = ESGF.get_selection('CORDEX', root=str(tmp_path), latest=True)
+    assert sorted(pruned.file_list) == sorted([old[0]] + new)
+
+
+
+def test_latest_cmip5(tmp_path):
+    # the version level is above the variable, pr only exists in the old version
+    path = os.path.join(str(tmp_path), cmip5_path.replace('v20111006/vas', '{}/{}'))
+    files = []
+    for version, variable in [('v20111006', 'vas'), ('v20111006', 'pr'), ('v20120101', 'vas')]:
+        os.makedirs(path.format(version, variable))
+        files.append(os.path.join(path.format(version, variable), cmip5_filename.replace('vas_', variable + '_')))
+        open(files[-1], 'w').close()
+    pruned = ESGF.get_selection('CMIP5', root=str(tmp_path), latest=True)
+    assert sorted(pruned.file_list) == sorted(files[1:])
+    # conventions without versions can not be pruned
+    with pytest.raises(Exception, match='version level'):
+        ESGF.conv.get_selection(ESGF.DKRZ.ERA5(root=str(tmp_path)), latest=True)
+
 
 if __name__ == '__main__':
     test_convs()
     test_cordex()
     test_cmip5()
+    test_cmip5_parse_list()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+import os
+import pickle
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from cordex import ESGF
+from cordex import metrics
+from cordex.catalog import FileCatalog, SharedCatalog, diff
+
+__author__ = "Lars Buntemeyer"
+__copyright__ = "Lars Buntemeyer"
+__license__ = "mit"
+
+
+def test_catalog_refresh(tmp_path, cordex_files):
+    root = str(tmp_path / 'cordex')
+    cordex_files(root, ['tas'], range(1950, 1955))
+    catalog = ESGF.get_catalog('CORDEX', str(tmp_path / 'cordex.db'), root=root)
+    assert catalog.refresh() == (5, 0)
+    # nothing changed
+    assert catalog.refresh() == (0, 0)
+    # incremental inserts and deletes
+    new = cordex_files(root, ['pr'], [1950])[0]
+    os.remove(cordex_files(root, ['tas'], [1950])[0])
+    assert catalog.refresh() == (1, 1)
+    assert len(catalog) == 5
+    selection = ESGF.get_selection('CORDEX', filter={'variable': 'pr'}, catalog=catalog)
+    assert selection.file_list == [new]
+    assert selection['startdate'].iloc[0] == '19500101'
+    # catalog persists on disk
+    catalog.close()
+    catalog = ESGF.get_catalog('CORDEX', str(tmp_path / 'cordex.db'), root=root)
+    assert len(catalog.query(variable='tas')) == 4
+
+
+def test_catalog_refresh_skips(tmp_path, cordex_files, monkeypatch):
+    root = str(tmp_path / 'cordex')
+    tas = cordex_files(root, ['tas'], [1950, 1951])
+    pr  = cordex_files(root, ['pr'], [1950])
+    open(os.path.join(os.path.dirname(tas[0]), '.' + os.path.basename(tas[0])), 'w').close()
+    os.makedirs(os.path.join(os.path.dirname(os.path.dirname(tas[0])), '.hidden'))
+    catalog = ESGF.get_catalog('CORDEX', str(tmp_path / 'cordex.db'), root=root)
+    assert catalog.refresh() == (3, 0)
+    assert len(catalog.rejected) == 0
+    scandir = os.scandir
+
+    def unreadable(path):
+        if path == os.path.dirname(tas[0]):
+            raise PermissionError(path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', unreadable)
+    os.remove(tas[1])
+    os.remove(pr[0])
+    collected = metrics.Metrics()
+    assert catalog.refresh(instrument=collected) == (0, 1)
+    assert collected.summary()['failed'] == 1
+    monkeypatch.undo()
+    assert catalog.refresh() == (0, 1)
+    assert catalog.query()['path'].tolist() == [os.path.relpath(tas[0], root)]
+
+def _shared_files(shared, offset, length):
+    return shared.selection(offset, length, columns=['variable', 'path']).file_list
+
+
+def test_shared_catalog(tmp_path, cordex_files):
+    root = str(tmp_path / 'cordex')
+    files = cordex_files(root)
+    selection = ESGF.get_selection('CORDEX', root=root)
+    with SharedCatalog.create(selection, directory=str(tmp_path)) as shared:
+        assert len(shared) == 20
+        # only the name is pickled
+        assert len(pickle.dumps(shared)) < 200
+        attached = SharedCatalog.attach(shared.name, directory=str(tmp_path))
+        assert attached.root == root
+        assert list(attached.slice(5, 3)['path']) == list(selection['path'][5:8])
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            chunks = list(executor.map(_shared_files, [shared] * 3, *zip(*shared.chunks(3))))
+        assert sum(chunks, []) == selection.file_list
+        assert sorted(sum(chunks, [])) == sorted(files)
+        attached.close()
+    # the owner removes the file
+    assert not os.path.exists(shared.filename)
+
+
+def test_diff(tmp_path, cordex_files):
+    root = str(tmp_path / 'cordex')
+    cordex_files(root)
+    old = ESGF.get_selection('CORDEX', root=root, stat=True)
+    old.to_parquet(str(tmp_path / 'old.parquet'))
+    removed = cordex_files(root, ['tas'], [1950])[0]
+    os.remove(removed)
+    added = cordex_files(root, ['ps'], [1950])[0]
+    with open(cordex_files(root, ['pr'], [1955])[0], 'w') as f:
+        f.write('data')
+    new = ESGF.get_selection('CORDEX', root=root, stat=True)
+    for changes in [diff(old, new), diff(str(tmp_path / 'old.parquet'), new, partitions=4, batch_size=3)]:
+        assert list(changes.added['path']) == [os.path.relpath(added, root)]
+        assert list(changes.removed['path']) == [os.path.relpath(removed, root)]
+        assert len(changes.modified) == 1
+        assert changes.modified['path'].iloc[0].endswith('19550101-19551231.nc')
+        assert changes.modified['size_new'].iloc[0] == 4
+    catalog = FileCatalog(str(tmp_path / 'catalog.db'), ESGF.get_convention('CORDEX', root=root))
+    with pytest.raises(Exception):
+        diff(catalog, new)
+    catalog.close()
@@ -2,7 +2,14 @@
 # flake8: noqa
 import pytest
 import os
-from cordex.conventions import FileNameConvention, FilePathConvention
+import time
+import asyncio
+import threading
+import contextlib
+import pandas as pd
+from cordex import metrics
+from cordex.conventions import (FileNameConvention, FilePathConvention, FileConvention,
+                                FileSelection, categorize, crawl, crawl_async)
 
 __author__ = "Lars Buntemeyer"
 __copyright__ = "Lars Buntemeyer"
@@ -41,7 +48,153 @@ def test_filepath_convention():
     print(conv.pattern(model='REMO2015', any_str='MISSING'))
 
 
+def test_filename_convention_parse_list():
+    conv_str = '{id:.2}{leveltype:.2}{hour:02d}_{frequency}_{date}_{code:.3}'
+    conv = FileNameConvention(conv_str)
+    files = ['/pool/ml00_1H/1979/E5ml00_1H_1979-01-01_129', 'E5ml12_1H_1979-01-01_130', 'E5ml00_1H']
+    attrs, rejected = conv.parse_list(files)
+    assert list(attrs.index) == [0, 1]
+    assert list(attrs['hour']) == [0, 12]
+    assert list(attrs['code']) == ['129', '130']
+    assert list(rejected) == ['E5ml00_1H']
+    assert conv.parse(files[0]) == attrs.loc[0].to_dict()
+
+
+
+def test_match_list_repeated_fields():
+    conv = FileNameConvention('{variable}_{model}_{variable}.nc')
+    files = ['tas_REMO_tas.nc', 'tas_REMO_pr.nc', 'pr_x_y_pr.nc']
+    attrs, rejected = conv.parse_list(files)
+    assert list(attrs['model']) == ['REMO', 'x_y'] and list(rejected) == ['tas_REMO_pr.nc']
+
+
+def test_selection_subset():
+    df = pd.DataFrame({'variable' : ['tas', 'tasmax', 'pr', 'tas', 'orog'],
+                       'frequency': ['day', 'day', 'day', 'mon', 'fx'],
+                       'startdate': ['1950', '1960', '1970', '1980', None]})
+    selection = FileSelection(categorize(df, ['variable', 'frequency']))
+    assert list(selection.subset(variable='tas').df.index) == [0, 3]
+    assert list(selection.subset(variable=['pr', 'orog']).df.index) == [2, 4]
+    assert list(selection.subset(variable='tas*', frequency='day').df.index) == [0, 1]
+    assert list(selection.subset(frequency='!day').df.index) == [3, 4]
+    assert list(selection.subset(variable='!ta*', frequency='!fx').df.index) == [2]
+    assert list(selection.subset(startdate=slice('1955', '1980')).df.index) == [1, 2, 3]
+    assert list(selection.subset(startdate=slice(None, '1960'), variable='tas').df.index) == [0]
+    assert list(selection.subset(variable='ps').df.index) == []
+
+
+class FakeEntry(object):
+
+    def __init__(self, name, is_dir):
+        self.name = name
+        self._is_dir = is_dir
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_file(self):
+        return not self._is_dir
+
+
+class FakeFileSystem(object):
+    """Directory tree in memory with an artificial latency per listing.
+    """
+
+    def __init__(self, files, latency=0.02):
+        self.latency = latency
+        self.tree = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        for f in files:
+            parts = f.split(os.sep)
+            for i in range(1, len(parts)):
+                self.tree.setdefault(os.sep.join(parts[:i]), {})[parts[i]] = i < len(parts) - 1
+
+    def scandir(self, path):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+        if path not in self.tree:
+            raise FileNotFoundError(path)
+        return contextlib.nullcontext([FakeEntry(n, d) for n, d in self.tree[path].items()])
+
+
+def test_crawl_async():
+    convention = FileConvention(FilePathConvention(['model', 'variable'], root='/archive'),
+                                FileNameConvention('{variable}_{year}.nc'))
+    files = ['/archive/model{}/var{}/var{}_{}.nc'.format(m, v, v, y)
+             for m in range(4) for v in range(8) for y in range(1950, 1953)]
+    fs = FakeFileSystem(files + ['/archive/model0/var0/README'])
+
+    async def collect():
+        return [record async for record in crawl_async(convention, scandir=fs.scandir, concurrency=32)]
+
+    serial = sorted(f for f, entry in crawl(convention, scandir=fs.scandir))
+    assert fs.max_in_flight == 1
+    records = asyncio.run(collect())
+    assert serial == sorted(files)
+    assert sorted(r['path'] for r in records) == sorted(files)
+    assert records[0]['year'] in ('1950', '1951', '1952')
+    # the model directories and their variable directories are listed concurrently
+    assert 4 <= fs.max_in_flight <= 32
+    with pytest.raises(Exception):
+        asyncio.run(crawl_async(convention, scandir=fs.scandir, errors='collect').__anext__())
+    # filters restrict the listed directories
+    fs.latency = 0
+    filtered = [f for f, entry in crawl(convention, filter={'model': 'model1', 'variable': 'var*'},
+                                        scandir=fs.scandir)]
+    assert len(filtered) == 24
+
+
+def test_crawl_unreadable():
+    convention = FileConvention(FilePathConvention(['model', 'variable'], root='/archive'),
+                                FileNameConvention('{variable}_{year}.nc'))
+    files = ['/archive/model{}/var0/var0_1950.nc'.format(m) for m in range(3)]
+    fs = FakeFileSystem(files, latency=0)
+
+    def scandir(path):
+        if path == '/archive/model1':
+            raise PermissionError(path)
+        return fs.scandir(path)
+
+    collected = metrics.Metrics()
+    found = sorted(f for f, entry in crawl(convention, scandir=scandir, instrument=collected))
+    assert found == [files[0], files[2]]
+    assert collected.summary()['failed'] == 1
+
+
+def test_crawl_multi_valued_filter():
+    convention = FileConvention(FilePathConvention(['model', 'variable'], root='/archive'),
+                                FileNameConvention('{variable}_{year}.nc'))
+    files = ['/archive/model{}/var{}/var{}_{}.nc'.format(m, v, v, y)
+             for m in range(4) for v in range(8) for y in range(1950, 1953)]
+    fs = FakeFileSystem(files, latency=0)
+    listed = []
+
+    def scandir(path):
+        listed.append(path)
+        return fs.scandir(path)
+
+    filter = {'model': ['model1', 'model2'], 'variable': ['var0', 'var3']}
+    found = sorted(f for f, entry in crawl(convention, filter=filter, scandir=scandir))
+    assert found == sorted(f for f in files if f.split('/')[2] in filter['model']
+                           and f.split('/')[3] in filter['variable'])
+    # fixed levels are not listed, each leaf directory is listed once
+    assert sorted(listed) == ['/archive/model1/var0', '/archive/model1/var3',
+                              '/archive/model2/var0', '/archive/model2/var3']
+    assert sorted(convention.path_conv.prefixes(**filter)) == sorted(listed)
+    assert len(convention.patterns(**filter)) == 4
+
+
 if __name__ == '__main__':
     test_filename_convention()
     test_filepath_convention()
+    test_filename_convention_parse_list()
+    test_selection_subset()
+    test_crawl_async()
+    test_crawl_multi_valued_filter()
 
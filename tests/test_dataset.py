@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+import datetime as dt
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+from cordex import ESGF
+from cordex.dataset import NC4Dataset, NC4MFDataset, NC4CatalogDataset, HandlePool, copy_dataset, pool, set_max_open_files
+
+__author__ = "Lars Buntemeyer"
+__copyright__ = "Lars Buntemeyer"
+__license__ = "mit"
+
+
+def create_dataset(filename, year=1950, ntime=365, units='days since 1949-12-01 00:00:00', format='NETCDF4'):
+    with Dataset(filename, 'w', format=format) as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('rlat', 2)
+        ds.createDimension('rlon', 3)
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = units
+        time.calendar = 'proleptic_gregorian'
+        start = (dt.datetime(year, 1, 1) - dt.datetime(1949, 12, 1)).days
+        time[:] = start + np.arange(ntime) + 0.5
+        tas = ds.createVariable('tas', 'f4', ('time', 'rlat', 'rlon'))
+        tas[:] = np.arange(ntime, dtype='f4')[:, None, None] * np.ones((2, 3), dtype='f4')
+    return filename
+
+
+def test_time_index(tmp_path):
+    ds = NC4Dataset(create_dataset(str(tmp_path / 'tas_1950.nc')))
+    date = dt.datetime(1950, 3, 1, 12)
+    assert ds.get_index_by_date(date) == 59
+    assert ds.time_index is ds.time_index
+    dates = [dt.datetime(1950, 1, 1, 12) + dt.timedelta(days=d) for d in [300, 0, 59]]
+    assert list(ds.get_index_by_dates(dates)) == [300, 0, 59]
+    assert list(ds.get_index_by_date(dates)) == [300, 0, 59]
+    assert ds.get_timestep(date, 'tas')[0, 0] == 59
+    assert ds.data_by_date('tas', date)[1, 2] == 59
+    assert ds.get_date_by_index(59) == date
+    with pytest.raises(ValueError):
+        ds.get_index_by_date(dt.datetime(1950, 3, 1))
+    assert ds.get_index_by_date(dt.datetime(1950, 3, 1), select='before') == 58
+    assert ds.get_index_by_date(dt.datetime(1950, 3, 1), select='after') == 59
+    assert ds.get_index_by_date(dt.datetime(1950, 3, 1, 13), select='nearest') == 59
+    ds.close()
+
+
+def test_catalog_dataset(tmp_path, cordex_files):
+    cordex_files(tmp_path, ['tas'], range(1950, 1955), writer=create_dataset)
+    selection = ESGF.get_selection('CORDEX', root=str(tmp_path))
+    ds = NC4CatalogDataset(selection)
+    assert len(ds) == 5
+    date = dt.datetime(1952, 3, 1, 12)
+    assert ds.get_timestep(date, 'tas')[0, 0] == 60
+    assert list(ds._time_indexes) == [2]
+    with ds.dataset_by_date(date) as nc:
+        assert nc.file_format == 'NETCDF4'
+    dates = [dt.datetime(1953, 1, 2, 12), dt.datetime(1952, 3, 1, 12), dt.datetime(1953, 1, 1, 12)]
+    assert list(ds.get_timesteps(dates, 'tas')[:, 0, 0]) == [1, 60, 0]
+    assert sorted(ds._time_indexes) == [2, 3]
+    with pytest.raises(ValueError):
+        ds.locate(dt.datetime(1960, 1, 1))
+    # idle files are closed by the pool
+    set_max_open_files(2)
+    dates = [dt.datetime(year, 6, 1, 12) for year in range(1950, 1955)]
+    assert len(ds.get_timesteps(dates, 'tas')) == 5
+    assert len(pool) <= 2
+    set_max_open_files(64)
+    ds.close()
+    subset = NC4CatalogDataset(selection.select_timerange((dt.datetime(1951, 6, 1), dt.datetime(1952, 6, 1))))
+    assert len(subset) == 2
+    assert subset.get_timestep(dt.datetime(1952, 12, 30, 12), 'tas')[0, 0] == 364
+    with pytest.raises(Exception):
+        NC4CatalogDataset(selection.to_datetime())
+    cordex_files(tmp_path, ['tas'], [1954], version='v20200101', writer=create_dataset)
+    with pytest.raises(Exception):
+        NC4CatalogDataset(ESGF.get_selection('CORDEX', root=str(tmp_path)))
+
+
+def test_handle_pool(tmp_path):
+    files = [create_dataset(str(tmp_path / 'tas_{}.nc'.format(year)), year=year) for year in (1950, 1951, 1952)]
+    handles = HandlePool(maxsize=2)
+    first = handles.acquire(files[0])
+    assert handles.acquire(files[0]) is first
+    handles.release(first)
+    second = handles.acquire(files[1])
+    handles.release(second)
+    third = handles.acquire(files[2])
+    # the first file is still in use, the second one is evicted
+    assert len(handles) == 2
+    assert first.isopen() and not second.isopen()
+    handles.resize(1)
+    assert len(handles) == 2
+    handles.release(first)
+    assert len(handles) == 1 and not first.isopen()
+    handles.release(third)
+    with handles.handle(files[2]) as handle:
+        assert handle is third
+    with pytest.raises(Exception):
+        handles.acquire(files[0], mode='a')
+    handles.clear()
+    assert len(handles) == 0 and not third.isopen()
+
+    pool.clear()
+    ds = NC4Dataset(files[0])
+    assert NC4Dataset(files[0]).ds is ds.ds
+    ds.close()
+    assert ds.ds.isopen()
+    pool.resize(1)
+    datasets = [NC4Dataset(f) for f in files]
+    assert len(pool) == 3
+    del datasets
+    assert len(pool) == 1
+    pool.resize(64)
+    ds = NC4Dataset(create_dataset(str(tmp_path / 'tas_1953.nc'), year=1953), mode='a')
+    ds.variables['tas'][0] = 1.
+    assert len(pool) == 1
+    ds.close()
+    classic = [create_dataset(str(tmp_path / 'pr_{}.nc'.format(year)), year=year, format='NETCDF4_CLASSIC')
+               for year in (1950, 1951)]
+    mf = NC4MFDataset(classic)
+    assert mf.variables['tas'].shape[0] == 730
+    mf.close()
+    copy = copy_dataset(files[1], varname='tas', destination=str(tmp_path / 'copy.nc'))
+    assert copy.variables['tas'].shape[0] == 365
+    copy.close()
+    pool.clear()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+import os
+import pytest
+from cordex import ESGF
+from cordex import inventory
+
+__author__ = "Lars Buntemeyer"
+__copyright__ = "Lars Buntemeyer"
+__license__ = "mit"
+
+simulation = {'product': 'output', 'CORDEX_domain': 'EUR-11', 'institute_id': 'GERICS',
+              'driving_model_id': 'MPI-M-MPI-ESM-LR', 'experiment_id': 'historical',
+              'ensemble_member': 'r3i1p1', 'model_id': 'GERICS-REMO2015', 'rcm_version_id': 'v1'}
+
+
+def test_time_chunks():
+    chunks = inventory.time_chunks('day', 1950, 2005)
+    assert list(chunks['startdate'][:3]) == ['19500101', '19510101', '19560101']
+    assert list(chunks['enddate'][-2:]) == ['20001231', '20051231']
+    chunks = inventory.time_chunks('sem', 1950, 1970)
+    assert list(chunks['startdate'] + '-' + chunks['enddate']) == ['194912-195011', '195012-196011',
+                                                                  '196012-197011']
+    assert len(inventory.time_chunks('3hr', 1950, 2005)) == 56
+    chunks = inventory.time_chunks('3hr', 1950, 1951, cell_method='a')
+    assert list(chunks['startdate'] + '-' + chunks['enddate']) == ['195001010130-195012312230',
+                                                                  '195101010130-195112312230']
+
+
+def test_compare(tmp_path):
+    root = str(tmp_path)
+    expected = inventory.expected_files(simulation, (1950, 1960), variables=['tas', 'pr'],
+                                        frequencies=['day', 'mon'])
+    # daily: 1950, 1951-1955, 1956-1960, monthly: 1950, 1951-1960
+    assert len(expected) == 2 * (3 + 2)
+    present = expected['path'].str.replace('*', 'v20190925', regex=False)
+    for path in list(present[1:]) + [present[0].replace('1950', '1949')]:
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        open(os.path.join(root, path), 'w').close()
+    selection = ESGF.get_selection('CORDEX', root=root)
+    report = inventory.compare(simulation, (1950, 1960), selection, variables=['tas', 'pr'],
+                               frequencies=['day', 'mon'])
+    assert list(report.missing['path']) == [expected['path'][0]]
+    assert len(report.unexpected) == 1
+    assert report.unexpected['startdate'].iloc[0].startswith('1949')
+
+
+def test_compare_subdaily(tmp_path):
+    root = str(tmp_path)
+    expected = inventory.expected_files(simulation, (2006, 2007), variables=['tas', 'pr'],
+                                        frequencies=['3hr'], version='v20190925')
+    dates = sorted(expected['startdate'] + '-' + expected['enddate'])
+    assert dates == ['200601010000-200612312100', '200601010130-200612312230',
+                     '200701010000-200712312100', '200701010130-200712312230']
+    for path in expected['path']:
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        open(os.path.join(root, path), 'w').close()
+    selection = ESGF.get_selection('CORDEX', root=root)
+    assert len(selection.df) == 4
+    report = inventory.compare(simulation, (2006, 2007), selection, variables=['tas', 'pr'],
+                               frequencies=['3hr'])
+    assert len(report.missing) == 0 and len(report.unexpected) == 0
+
+
+if __name__ == '__main__':
+    test_time_chunks()
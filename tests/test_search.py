@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+import os
+import json
+import threading
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+from cordex.search import SearchClient
+
+__author__ = "Lars Buntemeyer"
+__copyright__ = "Lars Buntemeyer"
+__license__ = "mit"
+
+recorded = os.path.join(os.path.dirname(__file__), 'data', 'esgf-search-cordex.json')
+
+
+class RecordedSearch(BaseHTTPRequestHandler):
+    """Serves pages of a recorded search response, filtered by variable.
+    """
+    requests = []
+
+    def do_GET(self):
+        params = parse_qsl(urlparse(self.path).query)
+        self.requests.append(params)
+        with open(recorded) as f:
+            docs = json.load(f)['response']['docs']
+        variables = [v for k, v in params if k == 'variable']
+        excluded  = [v for k, v in params if k == 'variable!']
+        rcm_names = [v for k, v in params if k == 'rcm_name']
+        docs = [d for d in docs if (not variables or d['variable'][0] in variables)
+                and d['variable'][0] not in excluded
+                and (not rcm_names or d['dataset_id'].split('.')[7] in rcm_names)]
+        offset, limit = int(dict(params)['offset']), int(dict(params)['limit'])
+        body = json.dumps({'response': {'numFound': len(docs), 'start': offset,
+                                        'docs': docs[offset:offset + limit]}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), RecordedSearch)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    RecordedSearch.requests = []
+    yield 'http://127.0.0.1:{}/esg-search/search'.format(httpd.server_port)
+    httpd.shutdown()
+
+
+def test_search(server, tmp_path):
+    client = SearchClient(server, cache=str(tmp_path / 'cache'), page_size=3, concurrency=4)
+    selection = client.search({'variable': 'tas', 'startdate': slice('1952', '19551231')})
+    assert len(RecordedSearch.requests) == 4
+    assert list(selection['variable'].unique()) == ['tas']
+    assert len(selection.df) == 4
+    assert selection['model_id'].iloc[0] == 'GERICS-REMO2015'
+    assert selection['url'].iloc[0].startswith('http://esgf1.dkrz.de/thredds/fileServer/')
+    assert selection['url'].iloc[0].endswith(selection['path'].iloc[0])
+    # cached responses
+    client.search({'variable': 'tas'})
+    assert len(RecordedSearch.requests) == 4
+    selection = client.search({'variable': '!tas'}, limit=5)
+    assert list(selection['variable'].unique()) == ['pr']
+    assert len(selection.df) == 5
+
+
+def test_search_prefixed(server):
+    client = SearchClient(server)
+    params, residual = client.params({'institute_id': 'GERICS', 'model_id': 'GERICS-REMO2015',
+                                      'version': 'v20190925'})
+    assert ('rcm_name', 'REMO2015') in params and ('version', '20190925') in params
+    assert residual == {}
+    params, residual = client.params({'model_id': 'GERICS-REMO2015'})
+    assert residual == {'model_id': 'GERICS-REMO2015'}
+    selection = client.search({'institute_id': 'GERICS', 'model_id': 'GERICS-REMO2015', 'variable': 'pr'})
+    assert len(selection.df) == 10
+    assert list(selection['model_id'].unique()) == ['GERICS-REMO2015']
+    assert selection['path'].iloc[0].startswith('output/EUR-11/GERICS/MPI-M-MPI-ESM-LR/historical/'
+                                                 'r3i1p1/GERICS-REMO2015/v1/day/pr/v20190925/')
+    assert len(client.search({'model_id': 'GERICS-REMO2015'}).df) == 20
+    assert len(client.search({'model_id': 'REMO2015'}).df) == 0